@@ -1,23 +1,127 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file
-from hdbcli import dbapi
+import atexit
+import time
+
+_BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, Response, render_template, stream_template, request, redirect, url_for, send_file, jsonify
 from dotenv import load_dotenv
 import os
-import pandas as pd
 import re
-from io import BytesIO
-
+import csv
+import hashlib
+import sqlite3
+import json
+import uuid
+import zlib
+import queue
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache, wraps
+from io import BytesIO, StringIO
+
+# Startup timing report: phase name -> seconds spent in that phase
+STARTUP_TIMINGS = {}
+
+def record_phase(name, started):
+    STARTUP_TIMINGS[name] = time.perf_counter() - started
+    return time.perf_counter()
+
+_phase = record_phase('imports', _BOOT_STARTED)
 
 load_dotenv()
+_phase = record_phase('load_dotenv', _phase)
 
 app = Flask(__name__)
+_phase = record_phase('flask_app', _phase)
+
+# SAP HANA Connection (opened lazily on first use, see get_conn)
+HANA_CONNECT_RETRIES = int(os.getenv("HANA_CONNECT_RETRIES", "3"))
+HANA_CONNECT_BACKOFF = float(os.getenv("HANA_CONNECT_BACKOFF", "0.5"))
+
+# One connection per thread: hdbcli connections must not be shared between threads
+# (dbapi.threadsafety == 1), and streamed pages keep a cursor open while other
+# requests run. _conns tracks them by thread id so close_conn can close them all.
+_conn_local = threading.local()
+_conns = {}
+_conn_lock = threading.Lock()
 
-# SAP HANA Connection
-conn = dbapi.connect(
-    address=os.getenv("HANA_HOST"),
-    port=int(os.getenv("HANA_PORT")),
-    user=os.getenv("HANA_USER"),
-    password=os.getenv("HANA_PASS")
-)
+def open_connection():
+    """Open a new HANA connection, retrying with exponential backoff"""
+    from hdbcli import dbapi
+
+    delay = HANA_CONNECT_BACKOFF
+    for attempt in range(1, HANA_CONNECT_RETRIES + 1):
+        try:
+            return dbapi.connect(
+                address=os.getenv("HANA_HOST"),
+                port=int(os.getenv("HANA_PORT")),
+                user=os.getenv("HANA_USER"),
+                password=os.getenv("HANA_PASS")
+            )
+        except dbapi.Error:
+            if attempt == HANA_CONNECT_RETRIES:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def get_conn():
+    """Return this thread's HANA connection, connecting (with retries) on first use"""
+    conn = getattr(_conn_local, 'conn', None)
+    if conn is not None and conn.isconnected():
+        return conn
+
+    started = time.perf_counter()
+    conn = open_connection()
+    STARTUP_TIMINGS.setdefault('hana_connect', time.perf_counter() - started)
+
+    with _conn_lock:
+        # Close what exited threads left behind (the dev server runs a thread per
+        # request) and this thread's dropped connection, if any
+        alive = {thread.ident for thread in threading.enumerate()}
+        ident = threading.get_ident()
+        for old_ident in [i for i in _conns if i not in alive or i == ident]:
+            close_quietly(_conns.pop(old_ident))
+        _conns[ident] = conn
+    _conn_local.conn = conn
+    return conn
+
+def get_pandas():
+    """Import pandas on first use - only the Excel upload/template routes need it"""
+    if 'pandas_import' not in STARTUP_TIMINGS:
+        started = time.perf_counter()
+        import pandas
+        STARTUP_TIMINGS['pandas_import'] = time.perf_counter() - started
+    import pandas
+    return pandas
+
+# In-flight uploads, drained on graceful shutdown (see drain)
+_inflight_uploads = 0
+_inflight_lock = threading.Condition()
+_draining = False
+_drain_started = None
+
+def tracks_upload(view):
+    """Count the request as an in-flight upload so shutdown can wait for it"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        global _inflight_uploads
+        with _inflight_lock:
+            _inflight_uploads += 1
+        try:
+            return view(*args, **kwargs)
+        finally:
+            with _inflight_lock:
+                _inflight_uploads -= 1
+                _inflight_lock.notify_all()
+    return wrapper
 
 SCHEMA = os.getenv("HANA_SCHEMA")
 CAMPAIGN_TABLE = "ACH_FCA_CAMPAIGN"
@@ -62,17 +166,173 @@ COLUMN_DISPLAY_NAMES = {
 def get_display_name(column_name):
     return COLUMN_DISPLAY_NAMES.get(column_name, column_name)
 
+# Columns stored as 1/0 and shown as Yes/No
+YES_NO_COLUMNS = frozenset(['FCA', 'IFCA', 'BVSHITS', 'BUNDLE'])
+YES_NO_VALUES = {1: 'Yes', '1': 'Yes', 0: 'No', '0': 'No', None: ''}
+
+def yes_no(value):
+    return YES_NO_VALUES.get(value, value)
+
+# Date/time and Decimal values as text - the form the read replica stores them
+# in - so output is the same whether a read was served by HANA or the replica
+VALUE_TEXT = {
+    date: date.isoformat,
+    datetime: lambda value: value.isoformat(' '),
+    Decimal: str
+}
+
+def plain_value(value):
+    to_text = VALUE_TEXT.get(type(value))
+    return value if to_text is None else to_text(value)
+
 # Function to convert 1/0 values to Yes/No for specific columns
 def convert_yes_no(value, column_name):
-    if column_name in ['FCA', 'IFCA', 'BVSHITS', 'BUNDLE']:
-        if value == 1 or value == '1':
-            return 'Yes'
-        elif value == 0 or value == '0':
-            return 'No'
-        elif value is None:
-            return ''
+    if column_name in YES_NO_COLUMNS:
+        return yes_no(value)
+    return value
+
+@lru_cache(maxsize=64)
+def display_names(columns):
+    """Display names for a tuple of column names, computed once per column set"""
+    return [get_display_name(col) for col in columns]
+
+@lru_cache(maxsize=64)
+def compile_row_formatter(columns):
+    """Build the row formatter for a tuple of column names once, instead of
+    checking every cell's column on every row. Used for HTML, export and API output."""
+    converters = tuple((i, yes_no) for i, col in enumerate(columns) if col in YES_NO_COLUMNS)
+
+    def format_row(row):
+        row = [plain_value(value) for value in row]
+        for i, convert in converters:
+            row[i] = convert(row[i])
+        return row
+    return format_row
+
+# Fields operators may change on an existing campaign / lookup row
+CAMPAIGN_EDITABLE_FIELDS = [
+    "CAMPAIGNNAME",
+    "STARTDATE",
+    "ENDDATE",
+    "STATUS",
+    "FCABUNDLERANGE",
+    "BVSHITS_TO_FCA_RANGE",
+    "IFCADATERANGE",
+    "RECHARGETYPE",
+    "RECHARGERNR",
+    "RECHARGERBR"
+]
+LOOKUP_BULK_FIELDS = ['STARTDATE', 'ENDDATE', 'TARGET', 'COMMISSION', 'MIN', 'MAX', 'CAP']
+
+# Optimistic concurrency: the edit form carries the version it was rendered from,
+# and the UPDATE only applies if the row still has that version
+def campaign_version(values):
+    """Version token for a campaign - hash of its editable fields (no MODIFICATIONDATE column)"""
+    payload = '|'.join(repr(values.get(col)) for col in CAMPAIGN_EDITABLE_FIELDS)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+def lookup_version(modificationdate):
+    """Version token for a lookup row - its MODIFICATIONDATE to the microsecond"""
+    if modificationdate is None:
+        return ''
+    return modificationdate.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def null_safe_match(columns, values):
+    """WHERE fragment matching each column to its value, treating None as IS NULL"""
+    clauses = []
+    params = []
+    for col, val in zip(columns, values):
+        if val is None:
+            clauses.append(f'"{col}" IS NULL')
+        else:
+            clauses.append(f'"{col}"=?')
+            params.append(val)
+    return ' AND '.join(clauses), params
+
+def empty_to_none(val):
+    return None if val == '' else val
+
+def form_date(value):
+    """YYYY-MM-DD from a date input, checked before it reaches HANA"""
+    datetime.strptime(value, '%Y-%m-%d')
     return value
 
+# Bulk edit values are converted like the add forms convert them; a value
+# that doesn't parse is a 400, not a driver error
+BULK_FIELD_PARSERS = {
+    'STARTDATE': form_date,
+    'ENDDATE': form_date,
+    'STATUS': int,
+    'RECHARGERNR': Decimal,
+    'RECHARGERBR': Decimal,
+    'TARGET': int,
+    'COMMISSION': float,
+    'MIN': float,
+    'MAX': float,
+    'CAP': float
+}
+
+def bulk_edit_value(field):
+    """The posted VALUE for `field`, converted; raises ValueError if it doesn't parse"""
+    value = empty_to_none(request.form.get("VALUE", ""))
+    parse = BULK_FIELD_PARSERS.get(field)
+    if value is None or parse is None:
+        return value
+    try:
+        return parse(value.strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid number: {value}")
+
+# Streaming list pages: rows are pulled from the cursor in batches and the HTML
+# is flushed as it is rendered, so big tables never sit in memory whole
+STREAM_FETCH_SIZE = int(os.getenv("STREAM_FETCH_SIZE", "500"))
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", str(16 * 1024)))
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "500"))
+
+def iter_rows(cursor):
+    """Yield cursor rows, fetching STREAM_FETCH_SIZE at a time"""
+    while True:
+        batch = cursor.fetchmany(STREAM_FETCH_SIZE)
+        if not batch:
+            return
+        yield from batch
+
+def page_window():
+    """LIMIT/OFFSET SQL for ?page=N (1-based) and the pager info; no paging unless asked for"""
+    page = request.args.get("page", type=int)
+    if not page or page < 1:
+        return '', None
+    per_page = min(max(request.args.get("per_page", LIST_PAGE_SIZE, type=int), 1), 10000)
+    args = request.args.to_dict()
+    pager = {
+        'page': page,
+        'per_page': per_page,
+        'prev_url': url_for(request.endpoint, **dict(args, page=page - 1)) if page > 1 else None,
+        'next_url': url_for(request.endpoint, **dict(args, page=page + 1))
+    }
+    return f' LIMIT {per_page} OFFSET {(page - 1) * per_page}', pager
+
+def stream_page(template_name, **context):
+    """Render a template as a streamed response, flushing about every STREAM_FLUSH_BYTES"""
+    def flushed(pieces):
+        buffer = []
+        size = 0
+        flush_at = 1024  # get the page head and nav out right away
+        for piece in pieces:
+            buffer.append(piece)
+            size += len(piece)
+            if size >= flush_at:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+                flush_at = STREAM_FLUSH_BYTES
+        if buffer:
+            yield ''.join(buffer)
+
+    response = Response(flushed(stream_template(template_name, **context)), mimetype='text/html')
+    response.headers['X-Accel-Buffering'] = 'no'  # don't let a proxy re-buffer the stream
+    return response
+
 # -----------------------------
 # Home / Welcome screen
 # -----------------------------
@@ -85,31 +345,67 @@ def home():
 # -----------------------------
 @app.route("/campaigns")
 def campaigns():
+    limit_sql, pager = page_window()
+
+    conn = read_conn(CAMPAIGN_TABLE)
     cursor = conn.cursor()
-    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{CAMPAIGN_TABLE}" ORDER BY CAMPAIGNID')
-    rows = cursor.fetchall()
+    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{CAMPAIGN_TABLE}" ORDER BY CAMPAIGNID{limit_sql}')
     columns = [c[0] for c in cursor.description]
 
     # Create display columns - include ALL columns
-    display_columns = [get_display_name(col) for col in columns]
-
-    # Convert rows to lists for template and convert 1/0 to Yes/No
-    extended_rows = []
-    for row in rows:
-        row_list = []
-        for i, value in enumerate(row):
-            converted_value = convert_yes_no(value, columns[i])
-            row_list.append(converted_value)
-        extended_rows.append(row_list)
-
-    return render_template("campaigns.html", 
-                         rows=extended_rows, 
-                         columns=columns,
-                         display_columns=display_columns, 
-                         zip=zip)
+    display_columns = display_names(tuple(columns))
+
+    # Convert 1/0 to Yes/No as rows are streamed to the template
+    format_row = compile_row_formatter(tuple(columns))
+    rows = (format_row(row) for row in iter_rows(cursor))
+
+    return stream_page("campaigns.html", 
+                       rows=rows, 
+                       columns=columns,
+                       display_columns=display_columns, 
+                       campaign_idx=columns.index('CAMPAIGNID'),
+                       visible_idx=[i for i, col in enumerate(columns) if col != 'TENANTID'],
+                       bulk_fields=[(col, get_display_name(col)) for col in CAMPAIGN_EDITABLE_FIELDS],
+                       pager=pager,
+                       zip=zip)
+
+@app.route("/campaigns/export")
+def export_campaigns():
+    """All campaigns as CSV, formatted the same way as the campaigns page"""
+    conn = read_conn(CAMPAIGN_TABLE)
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{CAMPAIGN_TABLE}" ORDER BY CAMPAIGNID')
+    columns = tuple(c[0] for c in cursor.description)
+    format_row = compile_row_formatter(columns)
+
+    def generate():
+        line = StringIO()
+        writer = csv.writer(line)
+        writer.writerow(display_names(columns))
+        for row in iter_rows(cursor):
+            writer.writerow(format_row(row))
+            if line.tell() >= STREAM_FLUSH_BYTES:
+                yield line.getvalue()
+                line.seek(0)
+                line.truncate()
+        yield line.getvalue()
+
+    return Response(generate(), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=campaigns.csv'})
+
+@app.route("/api/campaigns")
+def api_campaigns():
+    """All campaigns as JSON objects keyed by column name, formatted like the campaigns page"""
+    conn = read_conn(CAMPAIGN_TABLE)
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{CAMPAIGN_TABLE}" ORDER BY CAMPAIGNID')
+    columns = tuple(c[0] for c in cursor.description)
+    format_row = compile_row_formatter(columns)
+    return jsonify([dict(zip(columns, format_row(row))) for row in iter_rows(cursor)])
 
 @app.route("/campaigns/add", methods=["GET", "POST"])
 def add_campaign():
+    conn = get_conn()
     cursor = conn.cursor()
 
     if request.method == "POST":
@@ -146,7 +442,11 @@ def add_campaign():
         insert_stmt = f'INSERT INTO "{SCHEMA}"."{CAMPAIGN_TABLE}" ({",".join(columns)}) VALUES ({placeholders})'
 
         cursor.execute(insert_stmt, tuple(values))
+        cursor.execute('SELECT CURRENT_IDENTITY_VALUE() FROM DUMMY')
+        campaignid = cursor.fetchone()[0]
         conn.commit()
+        mark_replica_dirty(CAMPAIGN_TABLE, [campaignid])
+        audit('create', CAMPAIGN_TABLE, None, after=data)
         return redirect(url_for("campaigns"))
 
     # GET request: fetch columns excluding dependent fields
@@ -166,29 +466,13 @@ def add_campaign():
 
 @app.route("/campaigns/edit/<int:campaignid>", methods=["GET", "POST"])
 def edit_campaign(campaignid):
+    conn = get_conn()
     cursor = conn.cursor()
 
-    # Editable fields
-    editable_fields = [
-        "CAMPAIGNNAME",
-        "STARTDATE",
-        "ENDDATE",
-        "STATUS",
-        "FCABUNDLERANGE",
-        "BVSHITS_TO_FCA_RANGE",
-        "IFCADATERANGE",
-        "RECHARGETYPE",
-        "RECHARGERNR",
-        "RECHARGERBR"
-    ]
-
     if request.method == "POST":
-        def empty_to_none(val):
-            return None if val == '' else val
-
         # Collect only editable fields
         data = {}
-        for field in editable_fields:
+        for field in CAMPAIGN_EDITABLE_FIELDS:
             data[field] = empty_to_none(request.form.get(field, None))
 
         # If RECHARGETYPE != RECHARGER, clear recharge fields
@@ -196,25 +480,50 @@ def edit_campaign(campaignid):
             data['RECHARGERNR'] = None
             data['RECHARGERBR'] = None
 
-        # Build update statement dynamically
-        set_clause = ', '.join([f'"{col}"=?' for col in editable_fields])
-        values = [data[col] for col in editable_fields]
+        # Check the campaign still has the version the form was rendered from
+        select_cols = ','.join([f'"{col}"' for col in CAMPAIGN_EDITABLE_FIELDS])
+        cursor.execute(f'SELECT {select_cols} FROM "{SCHEMA}"."{CAMPAIGN_TABLE}" WHERE CAMPAIGNID=?', (campaignid,))
+        current = cursor.fetchone()
+        if current is None:
+            return "Campaign no longer exists", 404
+
+        conflict = "This campaign was changed by someone else. Review the current values and submit again to overwrite."
+        if request.form.get('VERSION') != campaign_version(dict(zip(CAMPAIGN_EDITABLE_FIELDS, current))):
+            return render_edit_campaign(cursor, campaignid, conflict)
+
+        # Build update statement dynamically; the guard makes the check-and-write atomic
+        set_clause = ', '.join([f'"{col}"=?' for col in CAMPAIGN_EDITABLE_FIELDS])
+        guard, guard_params = null_safe_match(CAMPAIGN_EDITABLE_FIELDS, current)
+        values = [data[col] for col in CAMPAIGN_EDITABLE_FIELDS]
         values.append(campaignid)  # for WHERE clause
+        values.extend(guard_params)
 
         cursor.execute(f'''
             UPDATE "{SCHEMA}"."{CAMPAIGN_TABLE}"
             SET {set_clause}
-            WHERE CAMPAIGNID=?
+            WHERE CAMPAIGNID=? AND {guard}
         ''', tuple(values))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return render_edit_campaign(cursor, campaignid, conflict)
         conn.commit()
+        mark_replica_dirty(CAMPAIGN_TABLE, [campaignid])
+        audit('edit', CAMPAIGN_TABLE, campaignid, before=dict(zip(CAMPAIGN_EDITABLE_FIELDS, current)),
+              after=data, campaignid=campaignid)
 
         return redirect(url_for("campaigns"))
 
-    # GET request: fetch existing campaign
+    return render_edit_campaign(cursor, campaignid)
+
+def render_edit_campaign(cursor, campaignid, conflict_message=None):
+    """Edit form for the current row; 409 when re-shown after a conflict, 404 if the row is gone"""
+    # Fetch existing campaign
     cursor.execute(f'SELECT * FROM "{SCHEMA}"."{CAMPAIGN_TABLE}" WHERE CAMPAIGNID=?', (campaignid,))
     campaign = cursor.fetchone()
     columns = [c[0] for c in cursor.description]
-    
+    if campaign is None:
+        return "Campaign not found", 404
+
     # Convert row to dictionary for easier access in template and convert 1/0 to Yes/No
     campaign_dict = {}
     for i, col in enumerate(columns):
@@ -225,17 +534,177 @@ def edit_campaign(campaignid):
 
     return render_template("edit_campaign.html", 
                          campaign=campaign_dict, 
+                         version=campaign_version(dict(zip(columns, campaign))),
+                         conflict_message=conflict_message,
                          columns=columns, 
                          display_columns=display_columns,
-                         zip=zip)
+                         zip=zip), 409 if conflict_message else 200
 
-@app.route("/campaigns/delete/<int:campaignid>")
-def delete_campaign(campaignid):
+@app.route("/campaigns/bulk-edit", methods=["POST"])
+def bulk_edit_campaigns():
+    """Apply one field change to all selected campaigns in a single UPDATE"""
+    field = request.form.get("FIELD")
+    if field not in CAMPAIGN_EDITABLE_FIELDS:
+        return "This field cannot be bulk edited", 400
+
+    try:
+        campaign_ids = [int(cid) for cid in request.form.getlist("CAMPAIGNID")]
+    except ValueError:
+        return "Invalid campaign selection", 400
+    if not campaign_ids:
+        return "No campaigns selected", 400
+
+    try:
+        data = {field: bulk_edit_value(field)}
+    except ValueError:
+        return f"Invalid value for {get_display_name(field)}", 400
+    where = f'CAMPAIGNID IN ({",".join(["?" for _ in campaign_ids])})'
+
+    # Keep the recharge rule: recharge values only apply to RECHARGER campaigns
+    if field == 'RECHARGETYPE' and data[field] != 'RECHARGER':
+        data['RECHARGERNR'] = None
+        data['RECHARGERBR'] = None
+    if field in ['RECHARGERNR', 'RECHARGERBR']:
+        where += " AND RECHARGETYPE='RECHARGER'"
+
+    conn = get_conn()
     cursor = conn.cursor()
-    cursor.execute(f'DELETE FROM "{SCHEMA}"."{CAMPAIGN_TABLE}" WHERE CAMPAIGNID=?', (campaignid,))
+
+    # Before images for the audit trail
+    select_cols = ','.join([f'"{col}"' for col in data])
+    cursor.execute(f'SELECT CAMPAIGNID, {select_cols} FROM "{SCHEMA}"."{CAMPAIGN_TABLE}" WHERE {where}',
+                   tuple(campaign_ids))
+    before = cursor.fetchall()
+
+    set_clause = ', '.join([f'"{col}"=?' for col in data])
+    cursor.execute(f'UPDATE "{SCHEMA}"."{CAMPAIGN_TABLE}" SET {set_clause} WHERE {where}',
+                   tuple(data.values()) + tuple(campaign_ids))
     conn.commit()
+    mark_replica_dirty(CAMPAIGN_TABLE, campaign_ids)
+
+    for row in before:
+        audit('bulk_edit', CAMPAIGN_TABLE, row[0], before=dict(zip(data, row[1:])), after=data, campaignid=row[0])
     return redirect(url_for("campaigns"))
 
+@app.route("/campaigns/delete/<int:campaignid>")
+def delete_campaign(campaignid):
+    # Cascade to the campaign's lookup rows so none are left orphaned
+    start_bulk_delete('campaigns', {'campaignid': campaignid}, cascade=True)
+    return redirect(url_for("bulk_delete"))
+
+# -----------------------------
+# Upload Deduplication
+# -----------------------------
+# Hashes of imported files live in a local sqlite file shared by all worker
+# processes, so re-sending an identical file is answered without parsing it.
+# Deleting rows from HANA drops the hashes of that kind (forget_deleted_rows);
+# anything left expires after UPLOAD_DEDUP_TTL_DAYS. Rows are always checked
+# against the table itself - lookup rows by key (existing_lookup_keys), campaign
+# rows by their uploaded columns (existing_campaign_rows) - so they need no history.
+UPLOAD_DEDUP_DB = os.getenv("UPLOAD_DEDUP_DB", os.path.join(tempfile.gettempdir(), "ach_fca_upload_dedup.sqlite3"))
+UPLOAD_DEDUP_TTL_DAYS = float(os.getenv("UPLOAD_DEDUP_TTL_DAYS", "30"))
+
+_dedup_schema_ready = False
+
+def dedup_db():
+    global _dedup_schema_ready
+    db = sqlite3.connect(UPLOAD_DEDUP_DB, timeout=30)
+    # The schema is created by the first connection in each process, not on every lookup
+    if not _dedup_schema_ready:
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS upload_files (
+                kind TEXT, sha256 TEXT, result TEXT, created REAL, PRIMARY KEY (kind, sha256))
+        ''')
+        db.commit()
+        _dedup_schema_ready = True
+    return db
+
+def file_sha256(file):
+    """SHA-256 of an uploaded file (path or file-like object, rewound afterwards)"""
+    digest = hashlib.sha256()
+    handle = open(file, 'rb') if isinstance(file, str) else file
+    try:
+        for block in iter(lambda: handle.read(64 * 1024), b''):
+            digest.update(block)
+    finally:
+        if isinstance(file, str):
+            handle.close()
+        else:
+            handle.seek(0)
+    return digest.hexdigest()
+
+def find_duplicate_upload(kind, sha256):
+    """Result of an earlier import of the identical file, or None"""
+    db = dedup_db()
+    try:
+        found = db.execute('SELECT result FROM upload_files WHERE kind=? AND sha256=? AND created>=?',
+                           (kind, sha256, time.time() - UPLOAD_DEDUP_TTL_DAYS * 86400)).fetchone()
+    finally:
+        db.close()
+    return json.loads(found[0]) if found else None
+
+def forget_deleted_rows(table):
+    """Rows were deleted from HANA: drop the file hashes of that kind, since any of
+    those files may hold a deleted row and must be importable again"""
+    kind = 'campaigns' if table == CAMPAIGN_TABLE else 'lookup'
+    db = dedup_db()
+    try:
+        db.execute('DELETE FROM upload_files WHERE kind=?', (kind,))
+        db.commit()
+    finally:
+        db.close()
+
+def record_upload_file(kind, sha256, result):
+    db = dedup_db()
+    try:
+        now = time.time()
+        db.execute('INSERT OR REPLACE INTO upload_files (kind, sha256, result, created) VALUES (?, ?, ?, ?)',
+                   (kind, sha256, json.dumps(result), now))
+        db.execute('DELETE FROM upload_files WHERE created<?', (now - UPLOAD_DEDUP_TTL_DAYS * 86400,))
+        db.commit()
+    finally:
+        db.close()
+
+def duplicate_upload_result(previous):
+    return dict(previous,
+                result_message="Identical file was already uploaded - nothing imported. Original result: "
+                               + previous['result_message'],
+                duplicate_file=True)
+
+def import_upload(kind, file, filename=None):
+    """Import an uploaded sheet unless the identical file was imported before.
+    Returns the result shown on the upload page."""
+    sha256 = file_sha256(file)
+    previous = find_duplicate_upload(kind, sha256)
+    if previous is not None:
+        return duplicate_upload_result(previous)
+
+    # One transaction for the whole file, so a failure part way leaves nothing behind
+    conn = get_conn()
+    conn.setautocommit(False)
+    try:
+        success_count, error_count, errors, duplicate_count, campaign_ids = UPLOAD_IMPORTERS[kind](file)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.setautocommit(True)
+
+    result = f"Imported: {success_count}, Errors: {error_count}"
+    if duplicate_count:
+        result += f", Skipped (already present): {duplicate_count}"
+    if errors:
+        result += "<br><br>" + "<br>".join(errors)
+    result = {'result_message': result, 'success_count': success_count,
+              'error_count': error_count, 'duplicate_count': duplicate_count}
+    record_upload_file(kind, sha256, result)
+    mark_replica_dirty(CAMPAIGN_TABLE if kind == 'campaigns' else LOOKUP_TABLE, campaign_ids)
+    # Uploads are audited as one event per file, not per imported row
+    audit('upload', CAMPAIGN_TABLE if kind == 'campaigns' else LOOKUP_TABLE, sha256,
+          after={'filename': filename or getattr(file, 'filename', None), 'imported': success_count,
+                 'errors': error_count, 'skipped': duplicate_count})
+    return result
+
 # -----------------------------
 # Excel Upload/Download Routes
 # -----------------------------
@@ -244,6 +713,7 @@ def download_campaign_template():
     """Download Excel template with instructions in right columns"""
     try:
         import io
+        pd = get_pandas()
         
         # Create main data DataFrame
         data = {
@@ -357,13 +827,185 @@ def download_campaign_template():
         return f"Error generating template: {str(e)}", 500
     
     
+def import_campaigns_file(file):
+    """Parse a campaign Excel sheet and insert its rows - ignore instruction columns safely.
+    Rows identical to a campaign already in the table (or earlier in the file) are skipped.
+    Returns (success_count, error_count, errors, duplicate_count, campaign_ids); the caller rolls back on failure"""
+    conn = get_conn()
+
+    # Expected REAL columns only (19)
+    expected_columns = [
+        'CAMPAIGNNAME', 'STARTDATE', 'ENDDATE', 'STATUS', 'FCA', 'IFCA',
+        'BVSHITS', 'BUNDLE', 'SALESTYPE', 'FCABUNDLERANGE', 'RETSIMBUN',
+        'BVSHITS_TO_FCA_RANGE', 'IFCADATERANGE', 'BUNDLEPRICETYPE',
+        'PRICETYPEVALUE', 'RECHARGETYPE', 'BUNDLETYPE',
+        'RECHARGERNR', 'RECHARGERBR'
+    ]
+
+    # Read full Excel sheet but as strings
+    pd = get_pandas()
+    df = pd.read_excel(file, dtype=str)
+
+    print("=== DEBUG: Original Columns ===")
+    print(df.columns.tolist())
+    print("===============================")
+
+    # Force pandas to keep ONLY the valid 19 columns
+    # (Ignore any instruction / extra columns safely)
+    df = df.reindex(columns=expected_columns)
+
+    print("=== DEBUG: After Filtering to Expected Columns ===")
+    print(df.columns.tolist())
+    print("===============================")
+
+    # Skip sample row & empty rows
+    df = df.iloc[1:]
+    df = df.dropna(how='all')
+
+    success_count = 0
+    error_count = 0
+    errors = []
+    duplicate_count = 0
+    new_campaign_ids = []
+    cursor = conn.cursor()
+
+    # Campaigns already in the table, so re-sent sheets don't create copies
+    existing_rows = existing_campaign_rows(cursor, expected_columns, df['CAMPAIGNNAME'].dropna())
+
+    for index, row in df.iterrows():
+        if row.isna().all():
+            continue
+
+        data = {}
+
+        # Loop through expected columns
+        for col in expected_columns:
+            value = row[col]
+
+            # Normalize nulls
+            if pd.isna(value) or str(value).strip() in ['', 'nan', 'None']:
+                value = None
+            else:
+                value = str(value).strip()
+
+            # Convert status
+            if col == 'STATUS' and value is not None:
+                v = value.lower()
+                if v in ['1', 'active', 'yes', 'true', 'y']:
+                    value = 1
+                elif v in ['0', 'inactive', 'no', 'false', 'n']:
+                    value = 0
+                else:
+                    value = None
+
+            # Convert FCA/IFCA/BVSHITS/BUNDLE
+            if col in ['FCA', 'IFCA', 'BVSHITS', 'BUNDLE'] and value is not None:
+                v = value.lower()
+                if v in ['1', 'yes', 'true', 'y']:
+                    value = 1
+                elif v in ['0', 'no', 'false', 'n']:
+                    value = 0
+                else:
+                    value = None
+
+            # Convert date formats (YYYY-MM-DD)
+            if col in ['STARTDATE', 'ENDDATE'] and value is not None:
+                try:
+                    parsed = pd.to_datetime(value)
+                    value = parsed.strftime('%Y-%m-%d')
+                except:
+                    pass
+
+            data[col] = value
+
+        # Required field validations
+        if not data['CAMPAIGNNAME']:
+            errors.append(f"Row {index+3}: CAMPAIGNNAME is required")
+            error_count += 1
+            continue
+
+        if not data['STARTDATE']:
+            errors.append(f"Row {index+3}: STARTDATE is required")
+            error_count += 1
+            continue
+
+        if not data['ENDDATE']:
+            errors.append(f"Row {index+3}: ENDDATE is required")
+            error_count += 1
+            continue
+
+        if data['STATUS'] is None:
+            errors.append(f"Row {index+3}: STATUS is required (use 1 or 0)")
+            error_count += 1
+            continue
+
+        # Clear RECHARGER fields if RECHARGETYPE != RECHARGER
+        if data.get('RECHARGETYPE') != 'RECHARGER':
+            data['RECHARGERNR'] = None
+            data['RECHARGERBR'] = None
+
+        # Skip rows already in the table or seen earlier in this file
+        match = campaign_match_key(data, expected_columns)
+        if match in existing_rows:
+            duplicate_count += 1
+            continue
+        existing_rows.add(match)
+
+        # Insert into database
+        cols = list(data.keys())
+        vals = list(data.values())
+        placeholders = ",".join(["?" for _ in cols])
+
+        query = f'INSERT INTO "{SCHEMA}"."{CAMPAIGN_TABLE}" ({",".join(cols)}) VALUES ({placeholders})'
+        cursor.execute(query, tuple(vals))
+        cursor.execute('SELECT CURRENT_IDENTITY_VALUE() FROM DUMMY')
+        new_campaign_ids.append(cursor.fetchone()[0])
+        success_count += 1
+
+    conn.commit()
+    return success_count, error_count, errors, duplicate_count, new_campaign_ids
+
+def campaign_match_key(values, columns):
+    """Comparable form of a campaign's uploaded columns, the same for a parsed sheet
+    row and a row read back from HANA (dates as YYYY-MM-DD, numbers without padding)"""
+    key = []
+    for col in columns:
+        value = values[col]
+        if isinstance(value, date):
+            value = value.strftime('%Y-%m-%d')
+        elif value is not None:
+            value = str(value).strip()
+            try:
+                value = str(Decimal(value).normalize())
+            except InvalidOperation:
+                pass
+        key.append(value)
+    return tuple(key)
+
+def existing_campaign_rows(cursor, columns, names):
+    """Match keys of the campaigns already in the table under any of the given names"""
+    rows = set()
+    names = list({str(name).strip() for name in names})
+    select_cols = ','.join([f'"{col}"' for col in columns])
+    for start in range(0, len(names), 1000):
+        batch = names[start:start + 1000]
+        cursor.execute(f'''
+            SELECT {select_cols} FROM "{SCHEMA}"."{CAMPAIGN_TABLE}"
+            WHERE CAMPAIGNNAME IN ({",".join(["?" for _ in batch])})
+        ''', tuple(batch))
+        rows.update(campaign_match_key(dict(zip(columns, row)), columns) for row in cursor.fetchall())
+    return rows
+
+
 @app.route("/campaigns/upload", methods=["GET", "POST"])
+@tracks_upload
 def upload_campaigns():
     """Handle Excel file upload - ignore instruction columns safely"""
     if request.method == "GET":
         return render_template("upload_campaign.html")
 
     if request.method == "POST":
+        conn = get_conn()
         try:
             if 'file' not in request.files:
                 return "No file uploaded", 400
@@ -375,131 +1017,8 @@ def upload_campaigns():
             if not file.filename.endswith(('.xlsx', '.xls')):
                 return "Please upload an Excel file", 400
 
-            # Expected REAL columns only (19)
-            expected_columns = [
-                'CAMPAIGNNAME', 'STARTDATE', 'ENDDATE', 'STATUS', 'FCA', 'IFCA',
-                'BVSHITS', 'BUNDLE', 'SALESTYPE', 'FCABUNDLERANGE', 'RETSIMBUN',
-                'BVSHITS_TO_FCA_RANGE', 'IFCADATERANGE', 'BUNDLEPRICETYPE',
-                'PRICETYPEVALUE', 'RECHARGETYPE', 'BUNDLETYPE',
-                'RECHARGERNR', 'RECHARGERBR'
-            ]
-
-            # Read full Excel sheet but as strings
-            df = pd.read_excel(file, dtype=str)
-
-            print("=== DEBUG: Original Columns ===")
-            print(df.columns.tolist())
-            print("===============================")
-
-            # Force pandas to keep ONLY the valid 19 columns
-            # (Ignore any instruction / extra columns safely)
-            df = df.reindex(columns=expected_columns)
-
-            print("=== DEBUG: After Filtering to Expected Columns ===")
-            print(df.columns.tolist())
-            print("===============================")
-
-            # Skip sample row & empty rows
-            df = df.iloc[1:]
-            df = df.dropna(how='all')
-
-            success_count = 0
-            error_count = 0
-            errors = []
-            cursor = conn.cursor()
-
-            for index, row in df.iterrows():
-                if row.isna().all():
-                    continue
-
-                data = {}
-
-                # Loop through expected columns
-                for col in expected_columns:
-                    value = row[col]
-
-                    # Normalize nulls
-                    if pd.isna(value) or str(value).strip() in ['', 'nan', 'None']:
-                        value = None
-                    else:
-                        value = str(value).strip()
-
-                    # Convert status
-                    if col == 'STATUS' and value is not None:
-                        v = value.lower()
-                        if v in ['1', 'active', 'yes', 'true', 'y']:
-                            value = 1
-                        elif v in ['0', 'inactive', 'no', 'false', 'n']:
-                            value = 0
-                        else:
-                            value = None
-
-                    # Convert FCA/IFCA/BVSHITS/BUNDLE
-                    if col in ['FCA', 'IFCA', 'BVSHITS', 'BUNDLE'] and value is not None:
-                        v = value.lower()
-                        if v in ['1', 'yes', 'true', 'y']:
-                            value = 1
-                        elif v in ['0', 'no', 'false', 'n']:
-                            value = 0
-                        else:
-                            value = None
-
-                    # Convert date formats (YYYY-MM-DD)
-                    if col in ['STARTDATE', 'ENDDATE'] and value is not None:
-                        try:
-                            parsed = pd.to_datetime(value)
-                            value = parsed.strftime('%Y-%m-%d')
-                        except:
-                            pass
-
-                    data[col] = value
-
-                # Required field validations
-                if not data['CAMPAIGNNAME']:
-                    errors.append(f"Row {index+3}: CAMPAIGNNAME is required")
-                    error_count += 1
-                    continue
-
-                if not data['STARTDATE']:
-                    errors.append(f"Row {index+3}: STARTDATE is required")
-                    error_count += 1
-                    continue
-
-                if not data['ENDDATE']:
-                    errors.append(f"Row {index+3}: ENDDATE is required")
-                    error_count += 1
-                    continue
-
-                if data['STATUS'] is None:
-                    errors.append(f"Row {index+3}: STATUS is required (use 1 or 0)")
-                    error_count += 1
-                    continue
-
-                # Clear RECHARGER fields if RECHARGETYPE != RECHARGER
-                if data.get('RECHARGETYPE') != 'RECHARGER':
-                    data['RECHARGERNR'] = None
-                    data['RECHARGERBR'] = None
-
-                # Insert into database
-                cols = list(data.keys())
-                vals = list(data.values())
-                placeholders = ",".join(["?" for _ in cols])
-
-                query = f'INSERT INTO "{SCHEMA}"."{CAMPAIGN_TABLE}" ({",".join(cols)}) VALUES ({placeholders})'
-                cursor.execute(query, tuple(vals))
-                success_count += 1
-
-            conn.commit()
-
-            # Response message
-            result = f"Imported: {success_count}, Errors: {error_count}"
-            if errors:
-                result += "<br><br>" + "<br>".join(errors)
-
-            return render_template("upload_campaign.html",
-                                   result_message=result,
-                                   success_count=success_count,
-                                   error_count=error_count)
+            result = import_upload('campaigns', file)
+            return render_template("upload_campaign.html", **result)
 
         except Exception as e:
             conn.rollback()
@@ -511,19 +1030,27 @@ def upload_campaigns():
 # -----------------------------
 @app.route("/lookup")
 def lookup():
+    limit_sql, pager = page_window()
+
+    conn = read_conn(LOOKUP_TABLE)
     cursor = conn.cursor()
-    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{LOOKUP_TABLE}" ORDER BY CAMPAIGNID')
-    rows = cursor.fetchall()
+    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{LOOKUP_TABLE}" ORDER BY CAMPAIGNID{limit_sql}')
     columns = [c[0] for c in cursor.description]
     
     # Create display columns
-    display_columns = [get_display_name(col) for col in columns]
+    display_columns = display_names(tuple(columns))
     
-    return render_template("lookup.html", 
-                         rows=rows, 
-                         columns=columns, 
-                         display_columns=display_columns,
-                         zip=zip)
+    return stream_page("lookup.html", 
+                       rows=iter_rows(cursor), 
+                       columns=columns, 
+                       display_columns=display_columns,
+                       campaign_idx=columns.index('CAMPAIGNID'),
+                       retailer_idx=columns.index('RETAILERID'),
+                       product_idx=columns.index('PRODUCTID'),
+                       visible_idx=[i for i, col in enumerate(columns) if col not in ['TENANTID', 'MODIFICATIONDATE']],
+                       bulk_fields=[(col, get_display_name(col)) for col in LOOKUP_BULK_FIELDS],
+                       pager=pager,
+                       zip=zip)
 
 @app.route("/lookup/add", methods=["GET", "POST"])
 def add_lookup():
@@ -554,6 +1081,7 @@ def add_lookup():
         if not campaignid or not retailerid or not productid:
             return "CAMPAIGNID, RETAILERID and PRODUCTID are required fields", 400
 
+        conn = get_conn()
         cursor = conn.cursor()
         cursor.execute(f'''
             INSERT INTO "{SCHEMA}"."{LOOKUP_TABLE}"
@@ -561,9 +1089,14 @@ def add_lookup():
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (campaignid, retailerid, productid, startdate, enddate, target, commission, min_val, max_val, cap))
         conn.commit()
+        mark_replica_dirty(LOOKUP_TABLE, [campaignid])
+        audit('create', LOOKUP_TABLE, f"{campaignid}/{retailerid}/{productid}", campaignid=campaignid,
+              after={'STARTDATE': startdate, 'ENDDATE': enddate, 'TARGET': target, 'COMMISSION': commission,
+                     'MIN': min_val, 'MAX': max_val, 'CAP': cap})
         return redirect(url_for("lookup"))
     
     # For GET request, show the form with display names
+    conn = get_conn()
     cursor = conn.cursor()
     cursor.execute(f'SELECT * FROM "{SCHEMA}"."{LOOKUP_TABLE}" LIMIT 1')
     columns = [c[0] for c in cursor.description]
@@ -581,6 +1114,7 @@ def download_lookup_template():
     """Download Excel template with instructions in right columns"""
     try:
         import io
+        pd = get_pandas()
         
         # Create main data DataFrame
         data = {
@@ -681,13 +1215,147 @@ def download_lookup_template():
         return f"Error generating template: {str(e)}", 500
     
     
+def import_lookup_file(file):
+    """Parse a lookup Excel sheet and insert its rows - ignore instruction columns safely.
+    Rows whose key already exists in the table (or earlier in the file) are skipped.
+    Returns (success_count, error_count, errors, duplicate_count, campaign_ids); the caller rolls back on failure"""
+    conn = get_conn()
+
+    # Expected REAL columns only (10)
+    expected_columns = [
+        'CAMPAIGNID', 'RETAILERID', 'PRODUCTID', 'STARTDATE', 'ENDDATE',
+        'TARGET', 'COMMISSION', 'MIN', 'MAX', 'CAP'
+    ]
+
+    # Read full Excel sheet but as strings
+    pd = get_pandas()
+    df = pd.read_excel(file, dtype=str)
+
+    print("=== DEBUG: Original Columns ===")
+    print(df.columns.tolist())
+    print("===============================")
+
+    # Force pandas to keep ONLY the valid 10 columns
+    # (Ignore any instruction / extra columns safely)
+    df = df.reindex(columns=expected_columns)
+
+    print("=== DEBUG: After Filtering to Expected Columns ===")
+    print(df.columns.tolist())
+    print("===============================")
+
+    # Skip sample row & empty rows
+    df = df.iloc[1:]
+    df = df.dropna(how='all')
+
+    success_count = 0
+    error_count = 0
+    errors = []
+    duplicate_count = 0
+    cursor = conn.cursor()
+
+    # Keys already in the table, so overlapping files don't fail on the composite key
+    campaign_ids = set()
+    for value in df['CAMPAIGNID'].dropna():
+        try:
+            campaign_ids.add(int(float(value)))
+        except ValueError:
+            pass
+    existing_keys = existing_lookup_keys(cursor, campaign_ids)
+
+    for index, row in df.iterrows():
+        if row.isna().all():
+            continue
+
+        data = {}
+
+        # Loop through expected columns
+        for col in expected_columns:
+            value = row[col]
+
+            # Normalize nulls
+            if pd.isna(value) or str(value).strip() in ['', 'nan', 'None']:
+                value = None
+            else:
+                value = str(value).strip()
+
+            # Convert numeric fields
+            if col in ['CAMPAIGNID', 'TARGET', 'COMMISSION', 'MIN', 'MAX', 'CAP'] and value is not None:
+                try:
+                    value = int(float(value))
+                except (ValueError, TypeError):
+                    value = None
+
+            # Convert date formats (YYYY-MM-DD)
+            if col in ['STARTDATE', 'ENDDATE'] and value is not None:
+                try:
+                    parsed = pd.to_datetime(value)
+                    value = parsed.strftime('%Y-%m-%d')
+                except:
+                    pass
+
+            data[col] = value
+
+        # Required field validations - ONLY these 3 are required
+        if not data['CAMPAIGNID']:
+            errors.append(f"Row {index+3}: CAMPAIGNID is required")
+            error_count += 1
+            continue
+
+        if not data['RETAILERID']:
+            errors.append(f"Row {index+3}: RETAILERID is required")
+            error_count += 1
+            continue
+
+        if not data['PRODUCTID']:
+            errors.append(f"Row {index+3}: PRODUCTID is required")
+            error_count += 1
+            continue
+
+        # All other fields (STARTDATE, ENDDATE, TARGET, etc.) are optional
+        # They can be None/empty
+
+        # Skip rows already in the table or seen earlier in this file
+        key = (data['CAMPAIGNID'], data['RETAILERID'], data['PRODUCTID'])
+        if key in existing_keys:
+            duplicate_count += 1
+            continue
+        existing_keys.add(key)
+
+        # Insert into database
+        cols = list(data.keys())
+        vals = list(data.values())
+        placeholders = ",".join(["?" for _ in cols])
+
+        query = f'INSERT INTO "{SCHEMA}"."{LOOKUP_TABLE}" ({",".join(cols)}) VALUES ({placeholders})'
+        cursor.execute(query, tuple(vals))
+        success_count += 1
+
+    conn.commit()
+    return success_count, error_count, errors, duplicate_count, campaign_ids
+
+def existing_lookup_keys(cursor, campaign_ids):
+    """(CAMPAIGNID, RETAILERID, PRODUCTID) keys already present for the given campaigns"""
+    keys = set()
+    campaign_ids = list(campaign_ids)
+    for start in range(0, len(campaign_ids), 1000):
+        batch = campaign_ids[start:start + 1000]
+        cursor.execute(f'''
+            SELECT CAMPAIGNID, RETAILERID, PRODUCTID FROM "{SCHEMA}"."{LOOKUP_TABLE}"
+            WHERE CAMPAIGNID IN ({",".join(["?" for _ in batch])})
+        ''', tuple(batch))
+        keys.update((int(c), r, p) for c, r, p in cursor.fetchall())
+    return keys
+
+
 @app.route("/lookup/upload", methods=["GET", "POST"])
+@tracks_upload
 def upload_lookup():
     """Handle Excel file upload - ignore instruction columns safely"""
     if request.method == "GET":
         return render_template("upload_lookup.html")
 
     if request.method == "POST":
+        conn = get_conn()
         try:
             if 'file' not in request.files:
                 return "No file uploaded", 400
@@ -699,108 +1367,8 @@ def upload_lookup():
             if not file.filename.endswith(('.xlsx', '.xls')):
                 return "Please upload an Excel file", 400
 
-            # Expected REAL columns only (10)
-            expected_columns = [
-                'CAMPAIGNID', 'RETAILERID', 'PRODUCTID', 'STARTDATE', 'ENDDATE',
-                'TARGET', 'COMMISSION', 'MIN', 'MAX', 'CAP'
-            ]
-
-            # Read full Excel sheet but as strings
-            df = pd.read_excel(file, dtype=str)
-
-            print("=== DEBUG: Original Columns ===")
-            print(df.columns.tolist())
-            print("===============================")
-
-            # Force pandas to keep ONLY the valid 10 columns
-            # (Ignore any instruction / extra columns safely)
-            df = df.reindex(columns=expected_columns)
-
-            print("=== DEBUG: After Filtering to Expected Columns ===")
-            print(df.columns.tolist())
-            print("===============================")
-
-            # Skip sample row & empty rows
-            df = df.iloc[1:]
-            df = df.dropna(how='all')
-
-            success_count = 0
-            error_count = 0
-            errors = []
-            cursor = conn.cursor()
-
-            for index, row in df.iterrows():
-                if row.isna().all():
-                    continue
-
-                data = {}
-
-                # Loop through expected columns
-                for col in expected_columns:
-                    value = row[col]
-
-                    # Normalize nulls
-                    if pd.isna(value) or str(value).strip() in ['', 'nan', 'None']:
-                        value = None
-                    else:
-                        value = str(value).strip()
-
-                    # Convert numeric fields
-                    if col in ['CAMPAIGNID', 'TARGET', 'COMMISSION', 'MIN', 'MAX', 'CAP'] and value is not None:
-                        try:
-                            value = int(float(value))
-                        except (ValueError, TypeError):
-                            value = None
-
-                    # Convert date formats (YYYY-MM-DD)
-                    if col in ['STARTDATE', 'ENDDATE'] and value is not None:
-                        try:
-                            parsed = pd.to_datetime(value)
-                            value = parsed.strftime('%Y-%m-%d')
-                        except:
-                            pass
-
-                    data[col] = value
-
-                # Required field validations - ONLY these 3 are required
-                if not data['CAMPAIGNID']:
-                    errors.append(f"Row {index+3}: CAMPAIGNID is required")
-                    error_count += 1
-                    continue
-
-                if not data['RETAILERID']:
-                    errors.append(f"Row {index+3}: RETAILERID is required")
-                    error_count += 1
-                    continue
-
-                if not data['PRODUCTID']:
-                    errors.append(f"Row {index+3}: PRODUCTID is required")
-                    error_count += 1
-                    continue
-
-                # All other fields (STARTDATE, ENDDATE, TARGET, etc.) are optional
-                # They can be None/empty
-
-                # Insert into database
-                cols = list(data.keys())
-                vals = list(data.values())
-                placeholders = ",".join(["?" for _ in cols])
-
-                query = f'INSERT INTO "{SCHEMA}"."{LOOKUP_TABLE}" ({",".join(cols)}) VALUES ({placeholders})'
-                cursor.execute(query, tuple(vals))
-                success_count += 1
-
-            conn.commit()
-
-            # Response message
-            result = f"Imported: {success_count}, Errors: {error_count}"
-            if errors:
-                result += "<br><br>" + "<br>".join(errors)
-
-            return render_template("upload_lookup.html",
-                                   result_message=result,
-                                   success_count=success_count,
-                                   error_count=error_count)
+            result = import_upload('lookup', file)
+            return render_template("upload_lookup.html", **result)
 
         except Exception as e:
             conn.rollback()
@@ -811,12 +1379,9 @@ def upload_lookup():
 
 @app.route("/lookup/edit/<int:campaignid>/<retailerid>/<productid>", methods=["GET", "POST"])
 def edit_lookup(campaignid, retailerid, productid):
+    conn = get_conn()
     cursor = conn.cursor()
 
-    # Helper function to convert empty strings to None for numeric columns
-    def empty_to_none(value):
-        return None if value == '' else value
-
     if request.method == "POST":
         # Get form values
         tenantid = request.form.get("TENANTID")  # read-only, but can still include if needed
@@ -829,77 +1394,1427 @@ def edit_lookup(campaignid, retailerid, productid):
         max_val = empty_to_none(request.form.get("MAX"))
         cap = empty_to_none(request.form.get("CAP"))
 
+        # Only update if MODIFICATIONDATE is still what the form was rendered from
+        version = request.form.get("VERSION", "")
+        if version:
+            guard = "TO_VARCHAR(MODIFICATIONDATE, 'YYYY-MM-DD HH24:MI:SS.FF6')=?"
+            guard_params = (version,)
+        else:
+            guard = "MODIFICATIONDATE IS NULL"
+            guard_params = ()
+
+        # Before image for the audit trail
+        cursor.execute(f'''
+            SELECT CAMPAIGNID, STARTDATE, ENDDATE, TARGET, COMMISSION, MIN, MAX, CAP
+            FROM "{SCHEMA}"."{LOOKUP_TABLE}"
+            WHERE CAMPAIGNID=? AND RETAILERID=? AND PRODUCTID=?
+        ''', (campaignid, retailerid, productid))
+        before = cursor.fetchone()
+        audit_columns = [c[0] for c in cursor.description]
+
         # Update the lookup table; update CAMPAIGNID as well
         cursor.execute(f'''
             UPDATE "{SCHEMA}"."{LOOKUP_TABLE}"
             SET CAMPAIGNID=?, STARTDATE=?, ENDDATE=?, TARGET=?, COMMISSION=?, MIN=?, MAX=?, CAP=?, MODIFICATIONDATE=CURRENT_TIMESTAMP
-            WHERE CAMPAIGNID=? AND RETAILERID=? AND PRODUCTID=?
-        ''', (new_campaignid, startdate, enddate, target, commission, min_val, max_val, cap, campaignid, retailerid, productid))
+            WHERE CAMPAIGNID=? AND RETAILERID=? AND PRODUCTID=? AND {guard}
+        ''', (new_campaignid, startdate, enddate, target, commission, min_val, max_val, cap, campaignid, retailerid, productid) + guard_params)
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return render_edit_lookup(cursor, campaignid, retailerid, productid,
+                                      "This lookup entry was changed by someone else. Review the current values and submit again to overwrite.")
         conn.commit()
+        mark_replica_dirty(LOOKUP_TABLE, [campaignid, new_campaignid])
+        audit('edit', LOOKUP_TABLE, f"{campaignid}/{retailerid}/{productid}", campaignid=campaignid,
+              before=dict(zip(audit_columns, before)) if before else None,
+              after=dict(zip(audit_columns, (new_campaignid, startdate, enddate, target, commission, min_val, max_val, cap))))
 
         return redirect(url_for("lookup"))
 
-    # GET request: fetch the existing row
+    return render_edit_lookup(cursor, campaignid, retailerid, productid)
+
+def render_edit_lookup(cursor, campaignid, retailerid, productid, conflict_message=None):
+    """Edit form for the current row; 409 when re-shown after a conflict, 404 if the row is gone"""
+    # Fetch the existing row
     cursor.execute(f'''
         SELECT * FROM "{SCHEMA}"."{LOOKUP_TABLE}"
         WHERE CAMPAIGNID=? AND RETAILERID=? AND PRODUCTID=?
     ''', (campaignid, retailerid, productid))
     lookup_row = cursor.fetchone()
     columns = [c[0] for c in cursor.description]
+    if lookup_row is None:
+        return "Lookup entry no longer exists", 404
 
     # Create display columns
     display_columns = [get_display_name(col) for col in columns]
 
     return render_template("edit_lookup.html", 
                          lookup=lookup_row, 
+                         version=lookup_version(lookup_row[columns.index('MODIFICATIONDATE')]),
+                         conflict_message=conflict_message,
                          columns=columns, 
                          display_columns=display_columns,
-                         zip=zip)
+                         zip=zip), 409 if conflict_message else 200
+
+@app.route("/lookup/bulk-edit", methods=["POST"])
+def bulk_edit_lookup():
+    """Apply one field change to all selected lookup rows as one batched UPDATE"""
+    field = request.form.get("FIELD")
+    if field not in LOOKUP_BULK_FIELDS:
+        return "This field cannot be bulk edited", 400
+
+    # Each selected row is posted as CAMPAIGNID/RETAILERID/PRODUCTID, as in the edit URL
+    keys = [key.split('/', 2) for key in request.form.getlist("KEY")]
+    if not keys:
+        return "No lookup entries selected", 400
+    if any(len(key) != 3 for key in keys):
+        return "Invalid lookup selection", 400
+    try:
+        keys = [(int(c), r, p) for c, r, p in keys]
+    except ValueError:
+        return "Invalid lookup selection", 400
+
+    try:
+        value = bulk_edit_value(field)
+    except ValueError:
+        return f"Invalid value for {get_display_name(field)}", 400
+
+    conn = get_conn()
+    cursor = conn.cursor()
+
+    # Before images for the audit trail, one query over the selected campaigns
+    campaign_ids = sorted({c for c, r, p in keys})
+    cursor.execute(f'''
+        SELECT CAMPAIGNID, RETAILERID, PRODUCTID, "{field}" FROM "{SCHEMA}"."{LOOKUP_TABLE}"
+        WHERE CAMPAIGNID IN ({','.join(['?'] * len(campaign_ids))})
+    ''', tuple(campaign_ids))
+    before = {f"{c}/{r}/{p}": old for c, r, p, old in cursor.fetchall()}
+
+    cursor.executemany(f'''
+        UPDATE "{SCHEMA}"."{LOOKUP_TABLE}"
+        SET "{field}"=?, MODIFICATIONDATE=CURRENT_TIMESTAMP
+        WHERE CAMPAIGNID=? AND RETAILERID=? AND PRODUCTID=?
+    ''', [(value, c, r, p) for c, r, p in keys])
+    conn.commit()
+    mark_replica_dirty(LOOKUP_TABLE, campaign_ids)
+
+    for c, r, p in keys:
+        row_key = f"{c}/{r}/{p}"
+        if row_key in before:
+            audit('bulk_edit', LOOKUP_TABLE, row_key, before={field: before[row_key]}, after={field: value}, campaignid=c)
+    return redirect(url_for("lookup"))
 
 @app.route("/lookup/delete/<int:campaignid>/<retailerid>/<productid>")
 def delete_lookup(campaignid, retailerid, productid):
+    conn = get_conn()
     cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT * FROM "{SCHEMA}"."{LOOKUP_TABLE}"
+        WHERE CAMPAIGNID=? AND RETAILERID=? AND PRODUCTID=?
+    ''', (campaignid, retailerid, productid))
+    before = cursor.fetchone()
+    columns = [c[0] for c in cursor.description]
     cursor.execute(f'''
         DELETE FROM "{SCHEMA}"."{LOOKUP_TABLE}" 
         WHERE CAMPAIGNID=? AND RETAILERID=? AND PRODUCTID=?
     ''', (campaignid, retailerid, productid))
     conn.commit()
+    mark_replica_dirty(LOOKUP_TABLE, [campaignid])
+    if before:
+        forget_deleted_rows(LOOKUP_TABLE)
+        audit('delete', LOOKUP_TABLE, f"{campaignid}/{retailerid}/{productid}", campaignid=campaignid,
+              before=dict(zip(columns, before)))
     return redirect(url_for("lookup"))
 
 #BULK DELETE
 
 @app.route('/lookup/delete_bulk/<int:campaign_id>')
 def delete_bulk_lookup(campaign_id):
-    cursor = conn.cursor()
-    cursor.execute(f'''
-        DELETE FROM "{SCHEMA}"."{LOOKUP_TABLE}" WHERE CAMPAIGNID=?
-    ''', (campaign_id,))
-    conn.commit()
-    return redirect(url_for('lookup'))
+    # Runs chunked in the background instead of one long-locking DELETE
+    start_bulk_delete('lookup', {'campaignid': campaign_id})
+    return redirect(url_for('bulk_delete'))
 
 
 
+# -----------------------------
+# Chunked / Resumable Uploads
+# -----------------------------
+# Protocol (used by static/chunked_upload.js):
+#   POST /uploads                      kind, filename, size, crc32 [, sha256] -> upload_id
+#                                      (an already imported sha256 comes back done)
+#   GET  /uploads/<id>                 status incl. next_chunk, to resume
+#   PUT  /uploads/<id>/chunks/<n>      raw bytes, optionally Content-Encoding: gzip,
+#                                      X-Chunk-CRC32 of the uncompressed bytes
+#   POST /uploads/<id>/complete        verify the whole file, then import it
+# Chunks are appended to a spool file on disk, so memory stays bounded and any
+# worker process can continue an upload.
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "ach_fca_uploads"))
+UPLOAD_MAX_CHUNK_BYTES = int(os.getenv("UPLOAD_MAX_CHUNK_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_SPOOL_TTL_HOURS = float(os.getenv("UPLOAD_SPOOL_TTL_HOURS", "24"))
+UPLOAD_READ_BLOCK = 64 * 1024
+
+UPLOAD_IMPORTERS = {
+    'campaigns': import_campaigns_file,
+    'lookup': import_lookup_file
+}
+
+def spool_paths(upload_id):
+    base = os.path.join(UPLOAD_SPOOL_DIR, upload_id)
+    return base + '.json', base + '.part'
+
+def load_upload(upload_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id):
+        return None
+    meta_path, _ = spool_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_upload(meta):
+    meta_path, _ = spool_paths(meta['id'])
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+class upload_lock:
+    """Serialize work on one upload across threads and worker processes"""
+    def __init__(self, upload_id):
+        self.path = os.path.join(UPLOAD_SPOOL_DIR, upload_id + '.lock')
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a')
+        try:
+            import fcntl
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+        except ImportError:
+            pass  # no fcntl on Windows; the dev server is single-process anyway
+        return self
+
+    def __exit__(self, *exc):
+        self.handle.close()
+
+def purge_stale_uploads():
+    cutoff = time.time() - UPLOAD_SPOOL_TTL_HOURS * 3600
+    for name in os.listdir(UPLOAD_SPOOL_DIR):
+        path = os.path.join(UPLOAD_SPOOL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def crc32_of_file(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(UPLOAD_READ_BLOCK), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+def read_chunk_body(stream, gzipped):
+    """Yield the request body in bounded blocks, gunzipping if needed"""
+    decompressor = zlib.decompressobj(wbits=31) if gzipped else None
+    for block in iter(lambda: stream.read(UPLOAD_READ_BLOCK), b''):
+        if decompressor is None:
+            yield block
+            continue
+        while block:
+            yield decompressor.decompress(block, UPLOAD_READ_BLOCK)
+            block = decompressor.unconsumed_tail
+    if decompressor is not None and not decompressor.eof:
+        raise ValueError('incomplete gzip stream')
+
+def upload_status(meta):
+    return {key: meta[key] for key in ['id', 'kind', 'filename', 'size', 'next_chunk', 'bytes_received', 'status', 'result']}
+
+@app.route("/uploads", methods=["POST"])
+def start_upload():
+    kind = request.form.get("kind")
+    filename = request.form.get("filename", "")
+    if kind not in UPLOAD_IMPORTERS:
+        return jsonify({'error': 'kind must be campaigns or lookup'}), 400
+    if not filename.endswith(('.xlsx', '.xls')):
+        return jsonify({'error': 'Please upload an Excel file'}), 400
+    try:
+        size = int(request.form["size"])
+        crc = int(request.form["crc32"])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'size and crc32 are required'}), 400
+    if size <= 0 or size > UPLOAD_MAX_FILE_BYTES:
+        return jsonify({'error': f'File must be between 1 and {UPLOAD_MAX_FILE_BYTES} bytes'}), 400
+
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    purge_stale_uploads()
+
+    meta = {
+        'id': uuid.uuid4().hex,
+        'kind': kind,
+        'filename': filename,
+        'size': size,
+        'crc32': crc,
+        'sha256': request.form.get("sha256") or None,
+        'next_chunk': 0,
+        'bytes_received': 0,
+        'status': 'receiving',
+        'result': None
+    }
+
+    # Identical file imported before: answer with its result without transferring anything
+    previous = find_duplicate_upload(kind, meta['sha256']) if meta['sha256'] else None
+    if previous is not None:
+        meta.update(status='done', bytes_received=size, result=duplicate_upload_result(previous))
+        save_upload(meta)
+        return jsonify(upload_status(meta)), 200
+
+    open(spool_paths(meta['id'])[1], 'wb').close()
+    save_upload(meta)
+    return jsonify(upload_status(meta)), 201
+
+@app.route("/uploads/<upload_id>")
+def get_upload(upload_id):
+    meta = load_upload(upload_id)
+    if meta is None:
+        return jsonify({'error': 'upload not found'}), 404
+    return jsonify(upload_status(meta))
+
+@app.route("/uploads/<upload_id>/chunks/<int:index>", methods=["PUT"])
+@tracks_upload
+def put_upload_chunk(upload_id, index):
+    if request.content_length and request.content_length > UPLOAD_MAX_CHUNK_BYTES:
+        return jsonify({'error': f'Chunks are limited to {UPLOAD_MAX_CHUNK_BYTES} bytes'}), 413
+    if load_upload(upload_id) is None:
+        return jsonify({'error': 'upload not found'}), 404
+
+    with upload_lock(upload_id):
+        meta = load_upload(upload_id)
+        if meta['status'] != 'receiving':
+            return jsonify(upload_status(meta)), 409
+        if index < meta['next_chunk']:
+            # Already have it - the client is resuming after a lost response
+            return jsonify(upload_status(meta))
+        if index > meta['next_chunk']:
+            return jsonify(dict(upload_status(meta), error=f"expected chunk {meta['next_chunk']}")), 409
+
+        gzipped = request.headers.get("Content-Encoding", "").lower() == "gzip"
+        remaining = meta['size'] - meta['bytes_received']
+        crc = 0
+        written = 0
+
+        _, part_path = spool_paths(upload_id)
+        with open(part_path, 'r+b') as spool:
+            # Drop anything a previously failed attempt left past the last good chunk
+            spool.truncate(meta['bytes_received'])
+            spool.seek(meta['bytes_received'])
+            try:
+                for block in read_chunk_body(request.stream, gzipped):
+                    written += len(block)
+                    if written > remaining:
+                        raise ValueError('chunk extends past the declared file size')
+                    crc = zlib.crc32(block, crc)
+                    spool.write(block)
+            except (ValueError, zlib.error) as e:
+                spool.truncate(meta['bytes_received'])
+                return jsonify(dict(upload_status(meta), error=str(e))), 400
+
+            expected_crc = request.headers.get("X-Chunk-CRC32")
+            if expected_crc is not None and int(expected_crc) != crc:
+                spool.truncate(meta['bytes_received'])
+                return jsonify(dict(upload_status(meta), error='chunk checksum mismatch')), 400
+
+        meta['next_chunk'] += 1
+        meta['bytes_received'] += written
+        save_upload(meta)
+        return jsonify(upload_status(meta))
+
+@app.route("/uploads/<upload_id>/complete", methods=["POST"])
+@tracks_upload
+def complete_upload(upload_id):
+    if load_upload(upload_id) is None:
+        return jsonify({'error': 'upload not found'}), 404
+
+    with upload_lock(upload_id):
+        meta = load_upload(upload_id)
+        if meta['status'] == 'done':
+            # Completed before - the client is retrying after a lost response
+            return jsonify(upload_status(meta))
+        if meta['status'] == 'failed':
+            return jsonify(dict(upload_status(meta), error=meta['error'])), 422
+
+        _, part_path = spool_paths(upload_id)
+        if meta['bytes_received'] != meta['size']:
+            return jsonify(dict(upload_status(meta), error='upload is not complete')), 409
+        if crc32_of_file(part_path) != meta['crc32'] or (meta['sha256'] and file_sha256(part_path) != meta['sha256']):
+            # Start over from scratch; the spool is corrupt somewhere
+            meta.update(next_chunk=0, bytes_received=0)
+            save_upload(meta)
+            return jsonify(dict(upload_status(meta), error='file checksum mismatch')), 400
+
+        try:
+            result = import_upload(meta['kind'], part_path, meta['filename'])
+        except Exception as e:
+            # import_upload rolled back; 422 so the client doesn't retry the import
+            meta['status'] = 'failed'
+            meta['error'] = f"Upload failed: {str(e)}"
+            save_upload(meta)
+            os.remove(part_path)
+            return jsonify(dict(upload_status(meta), error=meta['error'])), 422
+
+        meta['status'] = 'done'
+        meta['result'] = result
+        save_upload(meta)
+        os.remove(part_path)
+        return jsonify(upload_status(meta))
+
 # -----------------------------
 # Logs Table
 # -----------------------------
 @app.route("/logs")
 def logs():
+    # Only the hot window is shown; rows past LOG_RETENTION_DAYS are rolled up
+    # by log retention anyway, and a huge ?days= would overflow the date math
+    hot_days = min(max(request.args.get("days", LOGS_HOT_DAYS, type=int), 1),
+                   max(LOG_RETENTION_DAYS, LOGS_HOT_DAYS))
+    since = datetime.now() - timedelta(days=hot_days)
+
+    limit_sql, pager = page_window()
+
+    conn = get_conn()
     cursor = conn.cursor()
-    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{LOGS_TABLE}" ORDER BY COMPENSATIONDATE DESC')
-    rows = cursor.fetchall()
+    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{LOGS_TABLE}" WHERE COMPENSATIONDATE>=? ORDER BY COMPENSATIONDATE DESC{limit_sql}', (since,))
     columns = [c[0] for c in cursor.description]
     
     # Create display columns
-    display_columns = [get_display_name(col) for col in columns]
+    display_columns = display_names(tuple(columns))
     
-    return render_template("logs.html", 
-                         rows=rows, 
-                         columns=columns, 
-                         display_columns=display_columns,
-                         zip=zip)
+    return stream_page("logs.html", 
+                       rows=iter_rows(cursor), 
+                       columns=columns, 
+                       display_columns=display_columns,
+                       hot_days=hot_days,
+                       retention=load_log_retention_report(),
+                       pager=pager,
+                       zip=zip)
+
+# -----------------------------
+# Log Retention
+# -----------------------------
+LOGS_HOT_DAYS = int(os.getenv("LOGS_HOT_DAYS", "30"))
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "90"))
+LOG_RETENTION_INTERVAL_HOURS = float(os.getenv("LOG_RETENTION_INTERVAL_HOURS", "24"))
+LOG_ROLLUP_SLICE_MINUTES = int(os.getenv("LOG_ROLLUP_SLICE_MINUTES", "60"))
+# Daily totals, created on the first run if missing (see ensure_log_rollup_table):
+#
+#   CREATE COLUMN TABLE ACH_FCA_LOGS_DAILY (
+#       LOGDATE DATE, <LOG_ROLLUP_GROUP_COLUMNS as typed in ACH_FCA_LOGS>, LOGCOUNT BIGINT)
+LOG_ROLLUP_TABLE = os.getenv("LOG_ROLLUP_TABLE", "ACH_FCA_LOGS_DAILY")
+# Extra log columns to keep in the daily rollup besides LOGDATE, e.g. "CAMPAIGNID,RETAILERID"
+LOG_ROLLUP_GROUP_COLUMNS = [c.strip() for c in os.getenv("LOG_ROLLUP_GROUP_COLUMNS", "").split(",") if c.strip()]
+LOGS_INDEX = "IDX_ACH_FCA_LOGS_COMPDATE"
+
+# Result of the most recent retention run, shown on /logs and /logs/retention.
+# Kept in a file so every worker process sees the run done by the scheduler.
+LOG_RETENTION_REPORT_FILE = os.getenv("LOG_RETENTION_REPORT_FILE",
+                                      os.path.join(tempfile.gettempdir(), "ach_fca_log_retention.json"))
+_log_retention_lock = threading.Lock()
+_log_retention_thread = None
+
+def ensure_logs_index(cursor):
+    """Index COMPENSATIONDATE so hot-window queries don't scan the whole table"""
+    cursor.execute('SELECT COUNT(*) FROM SYS.INDEXES WHERE SCHEMA_NAME=? AND INDEX_NAME=?', (SCHEMA, LOGS_INDEX))
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f'CREATE INDEX "{SCHEMA}"."{LOGS_INDEX}" ON "{SCHEMA}"."{LOGS_TABLE}" (COMPENSATIONDATE)')
+
+def ensure_log_rollup_table(cursor):
+    """Create the daily totals table, with the group columns typed as in the logs table"""
+    cursor.execute('SELECT COUNT(*) FROM SYS.TABLES WHERE SCHEMA_NAME=? AND TABLE_NAME=?', (SCHEMA, LOG_ROLLUP_TABLE))
+    if cursor.fetchone()[0] == 0:
+        group_cols = ''.join([f', "{col}"' for col in LOG_ROLLUP_GROUP_COLUMNS])
+        cursor.execute(f'''
+            CREATE COLUMN TABLE "{SCHEMA}"."{LOG_ROLLUP_TABLE}" AS (
+                SELECT TO_DATE(COMPENSATIONDATE) AS LOGDATE{group_cols}, CAST(0 AS BIGINT) AS LOGCOUNT
+                FROM "{SCHEMA}"."{LOGS_TABLE}"
+            ) WITH NO DATA
+        ''')
+
+def logs_table_size(cursor):
+    """Memory footprint of the logs table in bytes, or None if monitoring views aren't readable"""
+    try:
+        cursor.execute('SELECT SUM(MEMORY_SIZE_IN_TOTAL) FROM SYS.M_CS_TABLES WHERE SCHEMA_NAME=? AND TABLE_NAME=?',
+                       (SCHEMA, LOGS_TABLE))
+        return cursor.fetchone()[0]
+    except Exception:
+        return None
+
+def rollup_log_slice(cursor, slice_start, slice_end):
+    """Add one time slice of raw logs to the daily totals, then delete it.
+    Returns (raw rows compacted, rollup rows written)."""
+    group_cols = ''.join([f', "{col}"' for col in LOG_ROLLUP_GROUP_COLUMNS])
+    cursor.execute(f'''
+        SELECT TO_DATE(COMPENSATIONDATE) AS LOGDATE{group_cols}, COUNT(*)
+        FROM "{SCHEMA}"."{LOGS_TABLE}"
+        WHERE COMPENSATIONDATE>=? AND COMPENSATIONDATE<?
+        GROUP BY TO_DATE(COMPENSATIONDATE){group_cols}
+    ''', (slice_start, slice_end))
+    totals = cursor.fetchall()
+
+    key_cols = ['LOGDATE'] + LOG_ROLLUP_GROUP_COLUMNS
+    for row in totals:
+        key_vals = list(row[:-1])
+        count = row[-1]
+        match, match_params = null_safe_match(key_cols, key_vals)
+        cursor.execute(f'UPDATE "{SCHEMA}"."{LOG_ROLLUP_TABLE}" SET LOGCOUNT=LOGCOUNT+? WHERE {match}',
+                       (count,) + tuple(match_params))
+        if cursor.rowcount == 0:
+            cols = ','.join([f'"{col}"' for col in key_cols])
+            cursor.execute(f'INSERT INTO "{SCHEMA}"."{LOG_ROLLUP_TABLE}" ({cols}, LOGCOUNT) VALUES ({",".join(["?" for _ in key_cols])}, ?)',
+                           tuple(key_vals) + (count,))
+
+    cursor.execute(f'DELETE FROM "{SCHEMA}"."{LOGS_TABLE}" WHERE COMPENSATIONDATE>=? AND COMPENSATIONDATE<?',
+                   (slice_start, slice_end))
+    return sum(row[-1] for row in totals), len(totals)
+
+def load_log_retention_report():
+    try:
+        with open(LOG_RETENTION_REPORT_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def run_log_retention():
+    """Roll logs older than LOG_RETENTION_DAYS into daily totals, one committed time slice at a time"""
+    if not _log_retention_lock.acquire(blocking=False):
+        return load_log_retention_report()
+
+    report = {'started': datetime.now().isoformat(timespec='seconds'), 'finished': None, 'rows_compacted': 0,
+              'rollup_rows_written': 0, 'slices': 0, 'bytes_reclaimed': None, 'error': None}
+    conn = None
+    try:
+        conn = open_connection()
+        conn.setautocommit(False)
+        cursor = conn.cursor()
+        ensure_logs_index(cursor)
+        ensure_log_rollup_table(cursor)
+        conn.commit()
+        size_before = logs_table_size(cursor)
+
+        cutoff = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=LOG_RETENTION_DAYS)
+        slice_size = timedelta(minutes=LOG_ROLLUP_SLICE_MINUTES)
+
+        while not _draining:
+            # The scheduler and POST /logs/retention (any worker) can run at the same
+            # time; the table lock, held until commit, keeps a slice from being counted twice
+            cursor.execute(f'LOCK TABLE "{SCHEMA}"."{LOGS_TABLE}" IN EXCLUSIVE MODE')
+
+            # Jump straight to the next non-empty slice
+            cursor.execute(f'SELECT MIN(COMPENSATIONDATE) FROM "{SCHEMA}"."{LOGS_TABLE}" WHERE COMPENSATIONDATE<?', (cutoff,))
+            oldest = cursor.fetchone()[0]
+            if oldest is None:
+                conn.commit()
+                break
+            slice_start = oldest
+            slice_end = min(slice_start + slice_size, cutoff)
+
+            compacted, written = rollup_log_slice(cursor, slice_start, slice_end)
+            conn.commit()
+            report['rows_compacted'] += compacted
+            report['rollup_rows_written'] += written
+            report['slices'] += 1
+
+        if report['rows_compacted']:
+            # Column store only frees deleted rows after a delta merge (HANA also auto-merges later)
+            try:
+                cursor.execute(f'MERGE DELTA OF "{SCHEMA}"."{LOGS_TABLE}"')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+            size_after = logs_table_size(cursor)
+            if size_before is not None and size_after is not None:
+                report['bytes_reclaimed'] = size_before - size_after
+    except Exception as e:
+        if conn is not None:
+            conn.rollback()
+        report['error'] = str(e)
+    finally:
+        if conn is not None:
+            conn.close()
+        report['finished'] = datetime.now().isoformat(timespec='seconds')
+        try:
+            with open(LOG_RETENTION_REPORT_FILE, 'w') as f:
+                json.dump(report, f)
+        except OSError:
+            pass
+        _log_retention_lock.release()
+    return report
+
+def start_log_retention_scheduler():
+    """Run log retention every LOG_RETENTION_INTERVAL_HOURS on a daemon thread.
+    Start it in one process only (see start_background_jobs, or the dev server)."""
+    global _log_retention_thread
+    if _log_retention_thread is not None or LOG_RETENTION_INTERVAL_HOURS <= 0:
+        return
+
+    def loop():
+        while True:
+            run_log_retention()
+            time.sleep(LOG_RETENTION_INTERVAL_HOURS * 3600)
+
+    _log_retention_thread = threading.Thread(target=loop, name="log-retention", daemon=True)
+    _log_retention_thread.start()
+
+@app.route("/logs/retention", methods=["GET", "POST"])
+def log_retention():
+    if request.method == "POST":
+        threading.Thread(target=run_log_retention, daemon=True).start()
+        return redirect(url_for("logs"))
+    return jsonify(load_log_retention_report())
+
+# -----------------------------
+# Bulk Delete / Archive
+# -----------------------------
+BULK_DELETE_CHUNK_SIZE = int(os.getenv("BULK_DELETE_CHUNK_SIZE", "5000"))
+# Archived rows are copied as-is into a table with the source table's columns,
+# created on first use (ensure_archive_table) as the equivalent of:
+#   CREATE COLUMN TABLE ACH_FCA_CAMPAIGN_ARCHIVE AS (SELECT * FROM ACH_FCA_CAMPAIGN) WITH NO DATA
+#   CREATE COLUMN TABLE ACH_FCA_LOOKUP_ARCHIVE AS (SELECT * FROM ACH_FCA_LOOKUP) WITH NO DATA
+# No key is copied over, so a row deleted, re-uploaded and deleted again can be archived twice.
+CAMPAIGN_ARCHIVE_TABLE = os.getenv("CAMPAIGN_ARCHIVE_TABLE", "ACH_FCA_CAMPAIGN_ARCHIVE")
+LOOKUP_ARCHIVE_TABLE = os.getenv("LOOKUP_ARCHIVE_TABLE", "ACH_FCA_LOOKUP_ARCHIVE")
+
+CAMPAIGN_KEY = ['CAMPAIGNID']
+LOOKUP_KEY = ['CAMPAIGNID', 'RETAILERID', 'PRODUCTID']
+
+# One JSON file per job, rewritten by the job thread after every chunk, so any
+# worker process can show progress (like the upload spool)
+BULK_JOB_DIR = os.getenv("BULK_JOB_DIR", os.path.join(tempfile.gettempdir(), "ach_fca_bulk_jobs"))
+MAX_BULK_JOBS_KEPT = 50
+
+def bulk_job_path(job_id):
+    return os.path.join(BULK_JOB_DIR, job_id + '.json')
+
+def save_bulk_job(job):
+    path = bulk_job_path(job['id'])
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+
+def load_bulk_job(job_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        return None
+    try:
+        with open(bulk_job_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def list_bulk_jobs():
+    """Newest jobs first; finished jobs beyond MAX_BULK_JOBS_KEPT are removed"""
+    try:
+        names = os.listdir(BULK_JOB_DIR)
+    except OSError:
+        return []
+    jobs = [load_bulk_job(name[:-5]) for name in names if name.endswith('.json')]
+    jobs = sorted([job for job in jobs if job is not None], key=lambda j: j['started'], reverse=True)
+    for job in jobs[MAX_BULK_JOBS_KEPT:]:
+        if job['status'] != 'running':
+            try:
+                os.remove(bulk_job_path(job['id']))
+            except OSError:
+                pass
+    return jobs[:MAX_BULK_JOBS_KEPT]
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def build_delete_filter(filters):
+    """WHERE clause for a bulk delete: campaign, retailer and/or date range"""
+    clauses = []
+    params = []
+    if filters.get('campaignid') is not None:
+        clauses.append('CAMPAIGNID=?')
+        params.append(filters['campaignid'])
+    if filters.get('retailerid'):
+        clauses.append('RETAILERID=?')
+        params.append(filters['retailerid'])
+    if filters.get('date_from'):
+        clauses.append('STARTDATE>=?')
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        clauses.append('ENDDATE<=?')
+        params.append(filters['date_to'])
+    return ' AND '.join(clauses), params
+
+def ensure_archive_table(conn, archive_table, table):
+    """Create the archive table for `table`, with the same columns, if it doesn't exist yet"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM SYS.TABLES WHERE SCHEMA_NAME=? AND TABLE_NAME=?', (SCHEMA, archive_table))
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f'''
+            CREATE COLUMN TABLE "{SCHEMA}"."{archive_table}" AS (
+                SELECT * FROM "{SCHEMA}"."{table}"
+            ) WITH NO DATA
+        ''')
+        conn.commit()
+
+def delete_in_chunks(conn, job, table, key_columns, where, params, archive_table=None):
+    """Delete (optionally archiving first) matching rows, committing every chunk.
+    Each deleted row is audited with its full before image."""
+    if archive_table:
+        ensure_archive_table(conn, archive_table, table)
+    cursor = conn.cursor()
+    key_match = ' AND '.join([f'"{col}"=?' for col in key_columns])
+
+    while not _draining:
+        cursor.execute(f'SELECT * FROM "{SCHEMA}"."{table}" WHERE {where} LIMIT {BULK_DELETE_CHUNK_SIZE}',
+                       tuple(params))
+        columns = [c[0] for c in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        if not rows:
+            return True
+        keys = [tuple(row[col] for col in key_columns) for row in rows]
+
+        if archive_table:
+            cursor.executemany(f'INSERT INTO "{SCHEMA}"."{archive_table}" SELECT * FROM "{SCHEMA}"."{table}" WHERE {key_match}', keys)
+        cursor.executemany(f'DELETE FROM "{SCHEMA}"."{table}" WHERE {key_match}', keys)
+        conn.commit()
+        mark_replica_dirty(table, [row['CAMPAIGNID'] for row in rows])
+        forget_deleted_rows(table)
+        for key, row in zip(keys, rows):
+            audit('delete', table, '/'.join(str(part) for part in key), before=row,
+                  campaignid=row['CAMPAIGNID'], user=job['user'])
+
+        job['rows_deleted'][table] = job['rows_deleted'].get(table, 0) + len(keys)
+        job['chunks'] += 1
+        save_bulk_job(job)
+    return False
+
+def run_bulk_delete(job):
+    """Background worker for one bulk delete job, on its own connection"""
+    conn = None
+    try:
+        conn = open_connection()
+        conn.setautocommit(False)
+        where, params = build_delete_filter(job['filters'])
+        lookup_archive = LOOKUP_ARCHIVE_TABLE if job['archive'] else None
+
+        if job['target'] == 'lookup':
+            finished = delete_in_chunks(conn, job, LOOKUP_TABLE, LOOKUP_KEY, where, params, lookup_archive)
+        else:
+            campaign_archive = CAMPAIGN_ARCHIVE_TABLE if job['archive'] else None
+            if job['cascade']:
+                # Child rows go first so an interrupted job never leaves orphans
+                finished = delete_in_chunks(conn, job, LOOKUP_TABLE, LOOKUP_KEY,
+                                            f'CAMPAIGNID IN (SELECT CAMPAIGNID FROM "{SCHEMA}"."{CAMPAIGN_TABLE}" WHERE {where})',
+                                            params, lookup_archive)
+            else:
+                finished = True
+            if finished:
+                finished = delete_in_chunks(conn, job, CAMPAIGN_TABLE, CAMPAIGN_KEY, where, params, campaign_archive)
+
+        job['status'] = 'done' if finished else 'interrupted'
+    except Exception as e:
+        if conn is not None:
+            conn.rollback()
+        job['status'] = 'failed'
+        job['error'] = str(e)
+    finally:
+        job['finished'] = time.time()
+        save_bulk_job(job)
+        if conn is not None:
+            conn.close()
+        # Plus one summary event per job, next to the per-row deletes
+        audit('bulk_delete', CAMPAIGN_TABLE if job['target'] == 'campaigns' else LOOKUP_TABLE,
+              f"job {job['id']}", campaignid=job['filters'].get('campaignid'), user=job['user'],
+              before=job['filters'],
+              after={'status': job['status'], 'archive': job['archive'], 'cascade': job['cascade'],
+                     'rows_deleted': job['rows_deleted'], 'error': job['error']})
+
+def start_bulk_delete(target, filters, archive=False, cascade=False):
+    """Queue a bulk delete of 'lookup' or 'campaigns' rows matching filters"""
+    job = {
+        'id': uuid.uuid4().hex,
+        'pid': os.getpid(),
+        'target': target,
+        'filters': filters,
+        'archive': archive,
+        'cascade': cascade,
+        'user': audit_user(),
+        'status': 'running',
+        'rows_deleted': {},
+        'chunks': 0,
+        'started': time.time(),
+        'finished': None,
+        'error': None
+    }
+    os.makedirs(BULK_JOB_DIR, exist_ok=True)
+    save_bulk_job(job)
+
+    threading.Thread(target=run_bulk_delete, args=(job,), daemon=True).start()
+    return job['id']
+
+def bulk_job_status(job):
+    """Progress snapshot with elapsed time and throughput"""
+    status = dict(job)
+    if status['status'] == 'running' and not process_alive(status['pid']):
+        # The worker running it was killed before it could record the outcome
+        status['status'] = 'interrupted'
+    elapsed = (status['finished'] or time.time()) - status['started']
+    total = sum(status['rows_deleted'].values())
+    status['total_deleted'] = total
+    status['elapsed_s'] = round(elapsed, 2)
+    status['rows_per_sec'] = round(total / elapsed, 1) if elapsed > 0 else 0
+    return status
+
+@app.route("/bulk-delete", methods=["GET", "POST"])
+def bulk_delete():
+    if request.method == "POST":
+        target = request.form.get("TARGET")
+        if target not in ['lookup', 'campaigns']:
+            return "TARGET must be lookup or campaigns", 400
+
+        campaignid = request.form.get("CAMPAIGNID", "").strip()
+        filters = {
+            'campaignid': int(campaignid) if campaignid.isdigit() else None,
+            'retailerid': request.form.get("RETAILERID", "").strip() or None,
+            'date_from': request.form.get("DATE_FROM") or None,
+            'date_to': request.form.get("DATE_TO") or None
+        }
+        if campaignid and filters['campaignid'] is None:
+            return "CAMPAIGNID must be a number", 400
+        if all(value is None for value in filters.values()):
+            return "At least one filter is required", 400
+        if target == 'campaigns' and filters['retailerid']:
+            return "RETAILERID only applies to lookup rows", 400
+
+        start_bulk_delete(target, filters,
+                          archive=request.form.get("ARCHIVE") == "1",
+                          cascade=request.form.get("CASCADE") == "1")
+        return redirect(url_for("bulk_delete"))
+
+    jobs = [bulk_job_status(job) for job in list_bulk_jobs()]
+
+    return render_template("bulk_delete.html",
+                           jobs=jobs,
+                           any_running=any(job['status'] == 'running' for job in jobs),
+                           chunk_size=BULK_DELETE_CHUNK_SIZE)
+
+@app.route("/bulk-delete/jobs/<job_id>")
+def bulk_delete_job(job_id):
+    job = load_bulk_job(job_id)
+    if job is None:
+        return jsonify({'error': 'job not found'}), 404
+    return jsonify(bulk_job_status(job))
+
+# -----------------------------
+# Audit Trail
+# -----------------------------
+# Who changed what, with before/after images as JSON. Routes only queue events;
+# a background writer per worker process inserts them in batches.
+#
+#   CREATE COLUMN TABLE ACH_FCA_AUDIT (
+#       CHANGEDAT TIMESTAMP, CHANGEDBY NVARCHAR(256), ACTION NVARCHAR(32),
+#       TABLENAME NVARCHAR(64), CAMPAIGNID INTEGER, ROWKEY NVARCHAR(512),
+#       BEFOREIMAGE NVARCHAR(5000), AFTERIMAGE NVARCHAR(5000))
+AUDIT_TABLE = os.getenv("AUDIT_TABLE", "ACH_FCA_AUDIT")
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", "2"))
+AUDIT_PUT_TIMEOUT = float(os.getenv("AUDIT_PUT_TIMEOUT", "5"))
+AUDIT_IMAGE_MAX_CHARS = 5000
+# Only set this when a trusted reverse proxy authenticates users and sets
+# X-Forwarded-User itself; otherwise any client could name itself in the trail
+AUDIT_TRUST_PROXY_USER = os.getenv("AUDIT_TRUST_PROXY_USER", "0") == "1"
+
+_audit_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+_audit_writer_pid = None
+_audit_writer_lock = threading.Lock()
+audit_stats = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0}
+
+def audit_user():
+    """Who is making the current request - the trusted proxy's user, else client address"""
+    if request:
+        if AUDIT_TRUST_PROXY_USER and request.headers.get('X-Forwarded-User'):
+            return request.headers['X-Forwarded-User']
+        return request.remote_addr
+    return 'system'
+
+def audit_image(values):
+    """JSON image for the audit table. When it would not fit the column, the
+    largest fields are dropped whole and listed under "_truncated", so the
+    stored text is always valid JSON."""
+    if values is None:
+        return None
+    image = json.dumps(values, default=str)
+    if len(image) <= AUDIT_IMAGE_MAX_CHARS:
+        return image
+
+    sizes = {field: len(json.dumps(value, default=str)) for field, value in values.items()}
+    kept = dict(values)
+    dropped = []
+    for field in sorted(sizes, key=sizes.get, reverse=True):
+        del kept[field]
+        dropped.append(field)
+        image = json.dumps(dict(kept, _truncated=dropped), default=str)
+        if len(image) <= AUDIT_IMAGE_MAX_CHARS:
+            return image
+    return json.dumps({'_truncated': True})
+
+def audit(action, table, row_key, before=None, after=None, campaignid=None, user=None):
+    """Queue an audit event. Blocks up to AUDIT_PUT_TIMEOUT when the writer is behind."""
+    ensure_audit_writer()
+    event = (datetime.now(), user or audit_user(), action, table, campaignid,
+             None if row_key is None else str(row_key), audit_image(before), audit_image(after))
+    try:
+        _audit_queue.put(event, timeout=AUDIT_PUT_TIMEOUT)
+        audit_stats['queued'] += 1
+    except queue.Full:
+        audit_stats['dropped'] += 1
+        print(f"Audit queue full - dropped {action} on {table} {row_key}")
+
+def ensure_audit_writer():
+    """Start the writer thread in this process (again after a fork)"""
+    global _audit_writer_pid
+    if _audit_writer_pid == os.getpid():
+        return
+    with _audit_writer_lock:
+        if _audit_writer_pid != os.getpid():
+            threading.Thread(target=audit_writer_loop, name="audit-writer", daemon=True).start()
+            _audit_writer_pid = os.getpid()
+
+def write_audit_batch(conn, batch):
+    """Insert one batch, reconnecting and retrying a few times. Returns the connection to reuse."""
+    for attempt in range(3):
+        try:
+            if conn is None or not conn.isconnected():
+                conn = open_connection()
+            cursor = conn.cursor()
+            cursor.executemany(f'''
+                INSERT INTO "{SCHEMA}"."{AUDIT_TABLE}"
+                (CHANGEDAT, CHANGEDBY, ACTION, TABLENAME, CAMPAIGNID, ROWKEY, BEFOREIMAGE, AFTERIMAGE)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+            conn.commit()
+            audit_stats['written'] += len(batch)
+            return conn
+        except Exception as e:
+            error = e
+            conn = None
+            time.sleep(2 ** attempt)
+    audit_stats['failed'] += len(batch)
+    print(f"Audit write failed, {len(batch)} events lost: {error}")
+    return conn
+
+def audit_writer_loop():
+    conn = None
+    while True:
+        # Wait for one event, then gather more for up to AUDIT_FLUSH_SECONDS
+        batch = [_audit_queue.get()]
+        deadline = time.monotonic() + AUDIT_FLUSH_SECONDS
+        while len(batch) < AUDIT_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_audit_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        conn = write_audit_batch(conn, batch)
+        for _ in batch:
+            _audit_queue.task_done()
+
+def flush_audit(timeout=30):
+    """Wait up to `timeout` seconds for queued audit events to be written"""
+    if _audit_writer_pid != os.getpid():
+        return True
+    deadline = time.monotonic() + timeout
+    with _audit_queue.all_tasks_done:
+        while _audit_queue.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _audit_queue.all_tasks_done.wait(remaining)
+    return True
+
+atexit.register(flush_audit)
+
+@app.route("/audit")
+def audit_history():
+    """Audit history, filtered by campaign and/or row key"""
+    campaignid = request.args.get("campaignid", type=int)
+    row_key = request.args.get("key", "").strip()
+
+    clauses = []
+    params = []
+    if campaignid is not None:
+        clauses.append('CAMPAIGNID=?')
+        params.append(campaignid)
+    if row_key:
+        clauses.append('ROWKEY LIKE ?')
+        params.append(row_key + '%')
+    where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    limit_sql, pager = page_window()
+
+    conn = get_conn()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT CHANGEDAT, CHANGEDBY, ACTION, TABLENAME, CAMPAIGNID, ROWKEY, BEFOREIMAGE, AFTERIMAGE
+        FROM "{SCHEMA}"."{AUDIT_TABLE}" {where}
+        ORDER BY CHANGEDAT DESC{limit_sql or ' LIMIT ' + str(LIST_PAGE_SIZE)}
+    ''', tuple(params))
+    columns = [c[0] for c in cursor.description]
+
+    return stream_page("audit.html",
+                       rows=iter_rows(cursor),
+                       columns=columns,
+                       campaignid=campaignid,
+                       row_key=row_key,
+                       stats=audit_stats,
+                       pager=pager,
+                       zip=zip)
+
+# -----------------------------
+# Local Read Replica
+# -----------------------------
+# With REPLICA_MODE=1 the campaign and lookup list/export reads are served from
+# a local sqlite copy instead of HANA. A sync thread (in one gunicorn worker,
+# or the dev server) keeps it current. Every REPLICA_SYNC_SECONDS:
+#   campaigns  - full refresh (small table, no modification date)
+#   lookup     - rows with MODIFICATIONDATE past the last pull, plus a key-only
+#                diff against HANA to pick up inserts and deletes
+# Writes always go to HANA, and each write request marks the campaigns it
+# touched (mark_replica_dirty). Reads of that table fall back to HANA until the
+# sync thread, polling every REPLICA_POLL_SECONDS, has re-pulled just those
+# campaigns' rows. Reads also fall back when the last full sync is older than
+# REPLICA_MAX_STALENESS_SECONDS - unless HANA is unreachable, in which case a
+# stale copy is served rather than an error.
+#
+# The replica file is attached under the HANA schema name, so the same
+# "SCHEMA"."TABLE" SQL runs against it unchanged.
+REPLICA_MODE = os.getenv("REPLICA_MODE", "0") == "1"
+REPLICA_DB = os.getenv("REPLICA_DB", os.path.join(tempfile.gettempdir(), "ach_fca_replica.sqlite3"))
+REPLICA_SYNC_SECONDS = float(os.getenv("REPLICA_SYNC_SECONDS", "60"))
+REPLICA_MAX_STALENESS_SECONDS = float(os.getenv("REPLICA_MAX_STALENESS_SECONDS", "300"))
+# Re-pull lookup rows modified this long before the last pull, for transactions
+# that committed after it with an earlier MODIFICATIONDATE
+REPLICA_DELTA_OVERLAP_SECONDS = int(os.getenv("REPLICA_DELTA_OVERLAP_SECONDS", "60"))
+REPLICA_POLL_SECONDS = 1
+REPLICA_KEY_CHUNK = 1000
+
+REPLICA_TABLES = {
+    CAMPAIGN_TABLE: CAMPAIGN_KEY,
+    LOOKUP_TABLE: LOOKUP_KEY
+}
+
+# HANA hands back Decimal and date/time values; store them as text, exactly as
+# the row formatter turns HANA's values into text
+for value_type, to_text in VALUE_TEXT.items():
+    sqlite3.register_adapter(value_type, to_text)
+
+_replica_local = threading.local()
+_replica_thread = None
+_replica_hana = None
+
+def open_replica():
+    """New sqlite connection with the replica attached as the HANA schema"""
+    db = sqlite3.connect(':memory:', timeout=30)
+    db.execute('ATTACH DATABASE ? AS "{}"'.format(SCHEMA), (REPLICA_DB,))
+    db.execute(f'PRAGMA "{SCHEMA}".journal_mode=WAL')
+    db.execute(f'''
+        CREATE TABLE IF NOT EXISTS "{SCHEMA}".replica_meta (
+            table_name TEXT PRIMARY KEY, columns TEXT, synced_at REAL, dirty_at REAL,
+            watermark TEXT, row_count INTEGER, last_error TEXT)
+    ''')
+    db.execute(f'''
+        CREATE TABLE IF NOT EXISTS "{SCHEMA}".replica_touched (
+            table_name TEXT, campaignid INTEGER, touched_at REAL, PRIMARY KEY (table_name, campaignid))
+    ''')
+    db.commit()
+    return db
+
+def replica_reader():
+    """This thread's replica connection - sqlite connections are not shared across threads"""
+    db = getattr(_replica_local, 'db', None)
+    if db is None:
+        db = _replica_local.db = open_replica()
+    return db
+
+def replica_state(db, table):
+    """(seconds since the last sync, dirty) for `table`, or None before its first sync"""
+    row = db.execute(f'SELECT synced_at, dirty_at FROM "{SCHEMA}".replica_meta WHERE table_name=?',
+                     (table,)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    return time.time() - row[0], row[1] is not None
+
+def replica_is_fresh(db, table):
+    state = replica_state(db, table)
+    return state is not None and not state[1] and state[0] <= REPLICA_MAX_STALENESS_SECONDS
+
+def read_conn(table):
+    """Connection for list/export reads of `table`: the replica when fresh enough, else HANA"""
+    if not REPLICA_MODE:
+        return get_conn()
+    try:
+        db = replica_reader()
+        if replica_is_fresh(db, table):
+            return db
+    except sqlite3.Error as e:
+        print(f"Replica unavailable, reading {table} from HANA: {e}")
+        return get_conn()
+
+    try:
+        return get_conn()
+    except Exception as e:
+        # HANA is down: a stale copy beats an error page
+        if replica_state(db, table) is None:
+            raise
+        print(f"HANA unavailable, serving {table} from a stale replica: {e}")
+        return db
+
+def mark_replica_dirty(table, campaignids):
+    """Send reads of `table` back to HANA until the sync thread has re-pulled the
+    written campaigns. Call once per write, after its commit."""
+    if not REPLICA_MODE:
+        return
+    try:
+        db = replica_reader()
+        now = time.time()
+        db.execute(f'UPDATE "{SCHEMA}".replica_meta SET dirty_at=? WHERE table_name=?', (now, table))
+        db.executemany(f'INSERT OR REPLACE INTO "{SCHEMA}".replica_touched VALUES (?, ?, ?)',
+                       [(table, campaignid, now) for campaignid in set(campaignids)])
+        db.commit()
+    except sqlite3.Error as e:
+        # Reads may be stale until the next scheduled sync, but the write itself succeeded
+        print(f"Could not mark replica dirty: {e}")
+
+def ensure_replica_table(db, table, columns):
+    """Create (or rebuild after a HANA column change) the local copy of `table`.
+    Returns True when the table is new and needs a full load."""
+    meta = db.execute(f'SELECT columns FROM "{SCHEMA}".replica_meta WHERE table_name=?', (table,)).fetchone()
+    if meta is not None and json.loads(meta[0]) == columns:
+        return False
+    col_defs = ', '.join(f'"{col}"' for col in columns)
+    key = ', '.join(f'"{col}"' for col in REPLICA_TABLES[table])
+    db.execute(f'DROP TABLE IF EXISTS "{SCHEMA}"."{table}"')
+    db.execute(f'CREATE TABLE "{SCHEMA}"."{table}" ({col_defs}, PRIMARY KEY ({key}))')
+    db.execute(f'''
+        INSERT OR REPLACE INTO "{SCHEMA}".replica_meta (table_name, columns, synced_at, dirty_at, watermark, row_count)
+        VALUES (?, ?, NULL, NULL, NULL, 0)
+    ''', (table, json.dumps(columns)))
+    return True
+
+def replica_insert(db, table, columns, rows):
+    placeholders = ','.join(['?'] * len(columns))
+    insert = f'INSERT OR REPLACE INTO "{SCHEMA}"."{table}" VALUES ({placeholders})'
+    count = 0
+    while True:
+        batch = rows.fetchmany(STREAM_FETCH_SIZE)
+        if not batch:
+            return count
+        db.executemany(insert, [tuple(row) for row in batch])
+        count += len(batch)
+
+def sync_campaigns(hana, db, watermark):
+    """Full refresh of the campaign table"""
+    cursor = hana.cursor()
+    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{CAMPAIGN_TABLE}"')
+    columns = [c[0] for c in cursor.description]
+    ensure_replica_table(db, CAMPAIGN_TABLE, columns)
+    db.execute(f'DELETE FROM "{SCHEMA}"."{CAMPAIGN_TABLE}"')
+    replica_insert(db, CAMPAIGN_TABLE, columns, cursor)
+
+def sync_lookup(hana, db, watermark):
+    """Delta pull of the lookup table; returns the new watermark (HANA clock)"""
+    cursor = hana.cursor()
+    cursor.execute('SELECT CURRENT_TIMESTAMP FROM DUMMY')
+    pulled_at = cursor.fetchone()[0]
+
+    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{LOOKUP_TABLE}" WHERE 1=0')
+    columns = [c[0] for c in cursor.description]
+    if ensure_replica_table(db, LOOKUP_TABLE, columns) or watermark is None:
+        cursor.execute(f'SELECT * FROM "{SCHEMA}"."{LOOKUP_TABLE}"')
+        replica_insert(db, LOOKUP_TABLE, columns, cursor)
+        return pulled_at
+
+    # Edited rows
+    since = datetime.fromisoformat(watermark) - timedelta(seconds=REPLICA_DELTA_OVERLAP_SECONDS)
+    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{LOOKUP_TABLE}" WHERE MODIFICATIONDATE>=?', (since,))
+    replica_insert(db, LOOKUP_TABLE, columns, cursor)
+
+    # Inserted and deleted rows, from the key sets on both sides
+    key_cols = ', '.join(LOOKUP_KEY)
+    cursor.execute(f'SELECT {key_cols} FROM "{SCHEMA}"."{LOOKUP_TABLE}"')
+    remote_keys = {tuple(row) for row in iter_rows(cursor)}
+    local_keys = set(db.execute(f'SELECT {key_cols} FROM "{SCHEMA}"."{LOOKUP_TABLE}"'))
+
+    gone = local_keys - remote_keys
+    db.executemany(f'DELETE FROM "{SCHEMA}"."{LOOKUP_TABLE}" WHERE {" AND ".join(f"{col}=?" for col in LOOKUP_KEY)}',
+                   list(gone))
+
+    missing_campaigns = sorted({key[0] for key in remote_keys - local_keys})
+    for start in range(0, len(missing_campaigns), REPLICA_KEY_CHUNK):
+        chunk = missing_campaigns[start:start + REPLICA_KEY_CHUNK]
+        cursor.execute(f'SELECT * FROM "{SCHEMA}"."{LOOKUP_TABLE}" WHERE CAMPAIGNID IN ({",".join(["?"] * len(chunk))})',
+                       tuple(chunk))
+        replica_insert(db, LOOKUP_TABLE, columns, cursor)
+    return pulled_at
+
+def sync_touched_campaigns(hana, db, table, campaignids):
+    """Replace the local rows of the given campaigns with HANA's current rows.
+    Returns False when HANA's columns changed and the table needs a full load."""
+    cursor = hana.cursor()
+    cursor.execute(f'SELECT * FROM "{SCHEMA}"."{table}" WHERE 1=0')
+    columns = [c[0] for c in cursor.description]
+    if ensure_replica_table(db, table, columns):
+        return False
+    for start in range(0, len(campaignids), REPLICA_KEY_CHUNK):
+        chunk = tuple(campaignids[start:start + REPLICA_KEY_CHUNK])
+        in_list = ','.join(['?'] * len(chunk))
+        db.execute(f'DELETE FROM "{SCHEMA}"."{table}" WHERE CAMPAIGNID IN ({in_list})', chunk)
+        cursor.execute(f'SELECT * FROM "{SCHEMA}"."{table}" WHERE CAMPAIGNID IN ({in_list})', chunk)
+        replica_insert(db, table, columns, cursor)
+    return True
+
+def replica_hana():
+    """The sync thread's own HANA connection, reopened after a drop"""
+    global _replica_hana
+    if _replica_hana is None or not _replica_hana.isconnected():
+        _replica_hana = open_connection()
+    return _replica_hana
+
+def finish_replica_sync(db, table, started, **meta):
+    """Record a successful sync of `table`. A write marked after the sync started
+    is not covered by it, so its campaigns stay touched and the table stays dirty."""
+    meta['row_count'] = db.execute(f'SELECT COUNT(*) FROM "{SCHEMA}"."{table}"').fetchone()[0]
+    assignments = ''.join(f'{column}=?, ' for column in meta)
+    db.execute(f'''
+        UPDATE "{SCHEMA}".replica_meta
+        SET {assignments}last_error=NULL,
+            dirty_at=CASE WHEN dirty_at < ? THEN NULL ELSE dirty_at END
+        WHERE table_name=?
+    ''', tuple(meta.values()) + (started, table))
+    db.execute(f'DELETE FROM "{SCHEMA}".replica_touched WHERE table_name=? AND touched_at < ?', (table, started))
+    db.commit()
+
+def replica_sync_failed(db, table, e):
+    db.rollback()
+    db.execute(f'UPDATE "{SCHEMA}".replica_meta SET last_error=? WHERE table_name=?', (str(e), table))
+    db.commit()
+    print(f"Replica sync of {table} failed: {e}")
+
+def sync_replica():
+    """Scheduled sync of both tables, one sqlite transaction per table"""
+    hana = replica_hana()
+    db = replica_reader()
+
+    for table, sync in ((CAMPAIGN_TABLE, sync_campaigns), (LOOKUP_TABLE, sync_lookup)):
+        started = time.time()
+        try:
+            meta = db.execute(f'SELECT watermark FROM "{SCHEMA}".replica_meta WHERE table_name=?',
+                              (table,)).fetchone()
+            watermark = sync(hana, db, meta[0] if meta else None)
+            finish_replica_sync(db, table, started, synced_at=started,
+                                watermark=None if watermark is None else str(watermark))
+        except Exception as e:
+            replica_sync_failed(db, table, e)
+
+def sync_replica_writes():
+    """Re-pull only the campaigns written since they were last synced.
+    Returns False when a table still needs the scheduled full sync."""
+    hana = replica_hana()
+    db = replica_reader()
+
+    complete = True
+    for table in REPLICA_TABLES:
+        started = time.time()
+        campaignids = [row[0] for row in db.execute(
+            f'SELECT campaignid FROM "{SCHEMA}".replica_touched WHERE table_name=?', (table,))]
+        if not campaignids:
+            continue
+        if replica_state(db, table) is None:
+            # Never loaded; the full sync covers these writes too
+            complete = False
+            continue
+        try:
+            if sync_touched_campaigns(hana, db, table, campaignids):
+                finish_replica_sync(db, table, started)
+            else:
+                db.commit()
+                complete = False
+        except Exception as e:
+            replica_sync_failed(db, table, e)
+    return complete
+
+def start_replica_sync():
+    """Keep the replica in sync on a daemon thread. Start it in one process only
+    (see start_background_jobs, or the dev server); other workers just read the file."""
+    global _replica_thread
+    if not REPLICA_MODE or _replica_thread is not None:
+        return
+
+    def loop():
+        last_sync = 0
+        while True:
+            # Full sync on schedule; in between, re-pull just the campaigns writes touched
+            try:
+                if time.monotonic() - last_sync >= REPLICA_SYNC_SECONDS:
+                    sync_replica()
+                    last_sync = time.monotonic()
+                elif replica_dirty() and not sync_replica_writes():
+                    last_sync = 0
+            except Exception as e:
+                print(f"Replica sync failed: {e}")
+                last_sync = time.monotonic()
+            time.sleep(REPLICA_POLL_SECONDS)
+
+    _replica_thread = threading.Thread(target=loop, name="replica-sync", daemon=True)
+    _replica_thread.start()
+
+def replica_dirty():
+    db = replica_reader()
+    return db.execute(f'SELECT 1 FROM "{SCHEMA}".replica_touched LIMIT 1').fetchone() is not None
+
+@app.route("/replica/status")
+def replica_status():
+    """Replica freshness per table"""
+    if not REPLICA_MODE:
+        return jsonify({'enabled': False})
+    db = replica_reader()
+    now = time.time()
+    tables = {}
+    for table, synced_at, dirty_at, row_count, last_error in db.execute(
+            f'SELECT table_name, synced_at, dirty_at, row_count, last_error FROM "{SCHEMA}".replica_meta'):
+        tables[table] = {
+            'age_s': None if synced_at is None else round(now - synced_at, 1),
+            'dirty': dirty_at is not None,
+            'serving_reads': replica_is_fresh(db, table),
+            'rows': row_count,
+            'last_error': last_error
+        }
+    return jsonify({'enabled': True, 'max_staleness_s': REPLICA_MAX_STALENESS_SECONDS, 'tables': tables})
+
+# -----------------------------
+# Startup Report
+# -----------------------------
+def startup_report():
+    """Boot cost broken down by phase, in milliseconds"""
+    phases = {name: round(seconds * 1000, 2) for name, seconds in STARTUP_TIMINGS.items()}
+    boot_phases = ['imports', 'load_dotenv', 'flask_app', 'routes']
+    return {
+        'phases_ms': phases,
+        'boot_ms': round(sum(phases.get(p, 0) for p in boot_phases), 2),
+        'hana_connected': bool(_conns),
+        'pandas_loaded': 'pandas_import' in STARTUP_TIMINGS
+    }
+
+@app.route("/startup-report")
+def startup_report_view():
+    return jsonify(startup_report())
+
+# -----------------------------
+# Worker Lifecycle / Readiness
+# -----------------------------
+def preload_templates():
+    """Compile every template up front so the first request doesn't pay for it"""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+def preload_driver():
+    """Import hdbcli once in the gunicorn master, so workers inherit the loaded module"""
+    try:
+        from hdbcli import dbapi
+    except ImportError:
+        pass
+
+def init_worker():
+    """Per-worker setup after fork - connections are never shared across processes"""
+    global _conn_local, _conns, _draining, _drain_started, _log_retention_lock, _replica_local
+    _conn_local = threading.local()
+    _conns = {}
+    _draining = False
+    _drain_started = None
+    _replica_local = threading.local()
+    _log_retention_lock = threading.Lock()
+
+# Background jobs run in one worker, never in the gunicorn master: the master
+# forks every worker (and every respawn), and a thread busy in sqlite or hdbcli
+# at that moment would leave its locks held in the child.
+BACKGROUND_LOCK_FILE = os.getenv("BACKGROUND_LOCK_FILE", os.path.join(tempfile.gettempdir(), "ach_fca_background.lock"))
+_background_lock = None
+
+def start_background_jobs():
+    """Start the scheduled background jobs if this worker wins the lock file.
+    The lock is held until the worker exits; the master's replacement for it
+    then takes over. Returns whether this worker runs them."""
+    global _background_lock
+    import fcntl
+    handle = open(BACKGROUND_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _background_lock = handle
+    start_log_retention_scheduler()
+    start_replica_sync()
+    return True
+
+def start_draining():
+    """Stop reporting ready and let background jobs wind down at their next chunk.
+    Returns when draining began (time.monotonic), the same on every call."""
+    global _draining, _drain_started
+    if _drain_started is None:
+        _drain_started = time.monotonic()
+        _draining = True
+    return _drain_started
+
+def drain(timeout):
+    """Wait up to `timeout` seconds for in-flight uploads to finish"""
+    start_draining()
+    deadline = time.monotonic() + timeout
+    with _inflight_lock:
+        while _inflight_uploads > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _inflight_lock.wait(remaining)
+        return _inflight_uploads == 0
+
+def close_conn():
+    """Close every thread's HANA connection in this process"""
+    with _conn_lock:
+        for conn in _conns.values():
+            close_quietly(conn)
+        _conns.clear()
+
+@app.route("/ready")
+def ready():
+    if _draining:
+        return jsonify({'ready': False, 'reason': 'draining'}), 503
+    try:
+        get_conn()
+    except Exception:
+        return jsonify({'ready': False, 'reason': 'database not connected'}), 503
+    return jsonify({'ready': True, 'inflight_uploads': _inflight_uploads})
+
+_phase = record_phase('routes', _phase)
 
 # -----------------------------
 # Run server
 # -----------------------------
 if __name__ == "__main__":
+    for name, ms in startup_report()['phases_ms'].items():
+        print(f"[startup] {name}: {ms} ms")
+    # The debug reloader runs this file twice; only the serving child runs the background jobs
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_log_retention_scheduler()
+        start_replica_sync()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,51 @@
+"""Micro-benchmark: per-cell convert_yes_no vs the compiled row formatter.
+
+    python bench_row_formatter.py [rows]
+
+Needs no database - importing app doesn't connect until a route runs.
+"""
+import sys
+import timeit
+from datetime import date
+from decimal import Decimal
+
+from app import compile_row_formatter, convert_yes_no, plain_value
+
+CAMPAIGN_COLUMNS = (
+    'TENANTID', 'CAMPAIGNID', 'CREATEDATE', 'CAMPAIGNNAME', 'STARTDATE', 'ENDDATE', 'STATUS',
+    'FCA', 'IFCA', 'BVSHITS', 'SALESTYPE', 'FCABUNDLERANGE', 'RETSIMBUN', 'BVSHITS_TO_FCA_RANGE',
+    'IFCADATERANGE', 'BUNDLEPRICETYPE', 'PRICETYPEVALUE', 'BUNDLE', 'RECHARGETYPE', 'BUNDLETYPE',
+    'RECHARGERNR', 'RECHARGERBR'
+)
+
+
+def sample_rows(count):
+    return [
+        ('T1', i, date(2025, 1, 1), f'Campaign {i}', date(2025, 1, 1), date(2025, 12, 31), 1,
+         i % 2, 0, 1, 'MNP', '10', None, '5', '10', 'RANGE', '100-200;200-300', i % 2,
+         'RECHARGER', 'POWER LOAD', Decimal('100'), Decimal('100.5'))
+        for i in range(count)
+    ]
+
+
+def per_cell(rows, columns):
+    return [[convert_yes_no(plain_value(value), columns[i]) for i, value in enumerate(row)] for row in rows]
+
+
+def compiled(rows, columns):
+    format_row = compile_row_formatter(columns)
+    return [format_row(row) for row in rows]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rows = sample_rows(count)
+    assert per_cell(rows, CAMPAIGN_COLUMNS) == compiled(rows, CAMPAIGN_COLUMNS)
+
+    for name, func in [('per-cell convert_yes_no', per_cell), ('compiled formatter', compiled)]:
+        best = min(timeit.repeat(lambda: func(rows, CAMPAIGN_COLUMNS), number=1, repeat=5))
+        print(f"{name:26s} {best * 1000:8.2f} ms total  {best / count * 1e6:6.2f} us/row")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Production server config
+#
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# Tunables (env): WEB_BIND, WEB_WORKERS, WEB_THREADS, WEB_TIMEOUT,
+# WEB_GRACEFUL_TIMEOUT. `python app.py` still runs the debug dev server.
+import multiprocessing
+import os
+import signal
+import time
+
+bind = os.getenv("WEB_BIND", "0.0.0.0:8000")
+
+# Processes scale across cores; threads cover requests blocked on HANA
+workers = int(os.getenv("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("WEB_THREADS", "4"))
+worker_class = "gthread"
+
+# Excel uploads can take a while on large sheets
+timeout = int(os.getenv("WEB_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "60"))
+keepalive = 5
+
+# Import the app (and compile templates) once in the master, then fork
+preload_app = True
+
+accesslog = "-"
+
+
+def when_ready(server):
+    import app as app_module
+    app_module.preload_templates()
+    app_module.preload_driver()
+
+
+def post_fork(server, worker):
+    # Reset per-process state; each request thread opens its own HANA connection
+    import app as app_module
+    app_module.init_worker()
+    # Log retention and the replica sync run in whichever one worker holds the
+    # lock file - never here in the master, which forks with them running
+    if app_module.start_background_jobs():
+        server.log.info("Worker %s runs the background jobs", worker.pid)
+
+
+def post_worker_init(worker):
+    # Start draining when SIGTERM arrives, while requests are still being served:
+    # /ready turns 503 and bulk delete / log retention stop at their next chunk
+    import app as app_module
+    handle_exit = worker.handle_exit
+
+    def draining_exit(sig, frame):
+        app_module.start_draining()
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, draining_exit)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def worker_exit(server, worker):
+    import app as app_module
+    # The master SIGKILLs graceful_timeout after SIGTERM and gunicorn has already
+    # spent part of that on open requests; both waits share what is left
+    deadline = app_module.start_draining() + graceful_timeout - 1
+    if not app_module.drain(deadline - time.monotonic()):
+        server.log.warning("Worker %s exiting with uploads still in flight", worker.pid)
+    if not app_module.flush_audit(deadline - time.monotonic()):
+        server.log.warning("Worker %s exiting with audit events still queued", worker.pid)
+    app_module.close_conn()
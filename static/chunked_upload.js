@@ -0,0 +1,160 @@
+// Chunked, resumable Excel upload for the upload forms (see "Chunked / Resumable
+// Uploads" in app.py). Chunks are gzipped when the browser supports it, and an
+// interrupted upload of the same file continues from the last stored chunk.
+(function () {
+    const CHUNK_SIZE = 1024 * 1024;
+    const MAX_ATTEMPTS = 5;
+
+    const CRC_TABLE = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+        }
+        CRC_TABLE[n] = c >>> 0;
+    }
+
+    // Same value as Python's zlib.crc32(bytes, crc)
+    function crc32(bytes, crc) {
+        crc = (crc ^ 0xFFFFFFFF) >>> 0;
+        for (let i = 0; i < bytes.length; i++) {
+            crc = CRC_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+        }
+        return (crc ^ 0xFFFFFFFF) >>> 0;
+    }
+
+    async function readSlice(file, start) {
+        return new Uint8Array(await file.slice(start, start + CHUNK_SIZE).arrayBuffer());
+    }
+
+    async function fileCrc32(file) {
+        let crc = 0;
+        for (let start = 0; start < file.size; start += CHUNK_SIZE) {
+            crc = crc32(await readSlice(file, start), crc);
+        }
+        return crc;
+    }
+
+    // SHA-256 lets the server skip files it has imported before; only available on secure origins
+    async function fileSha256(file) {
+        if (!window.crypto || !crypto.subtle) return null;
+        const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function gzip(bytes) {
+        if (!window.CompressionStream) return null;
+        const stream = new Blob([bytes]).stream().pipeThrough(new CompressionStream('gzip'));
+        return new Uint8Array(await new Response(stream).arrayBuffer());
+    }
+
+    // Retry network failures and 5xx with backoff; 4xx responses are returned as-is
+    async function send(url, options) {
+        let delay = 500;
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await fetch(url, options);
+                if (response.status < 500 || attempt === MAX_ATTEMPTS) {
+                    return { ok: response.ok, status: response.status, body: await response.json() };
+                }
+            } catch (err) {
+                if (attempt === MAX_ATTEMPTS) throw err;
+            }
+            await new Promise(resolve => setTimeout(resolve, delay));
+            delay *= 2;
+        }
+    }
+
+    async function resumeOrStart(file, kind) {
+        const resumeKey = `upload:${kind}:${file.name}:${file.size}:${file.lastModified}`;
+        const savedId = localStorage.getItem(resumeKey);
+        if (savedId) {
+            const saved = await send(`/uploads/${savedId}`, {});
+            if (saved.ok && saved.body.status === 'receiving') return { resumeKey, status: saved.body };
+        }
+
+        const form = new FormData();
+        form.append('kind', kind);
+        form.append('filename', file.name);
+        form.append('size', file.size);
+        form.append('crc32', await fileCrc32(file));
+        const sha256 = await fileSha256(file);
+        if (sha256) form.append('sha256', sha256);
+        const started = await send('/uploads', { method: 'POST', body: form });
+        if (!started.ok) throw new Error(started.body.error);
+        localStorage.setItem(resumeKey, started.body.id);
+        return { resumeKey, status: started.body };
+    }
+
+    async function upload(file, kind, progress) {
+        let { resumeKey, status } = await resumeOrStart(file, kind);
+
+        while (status.bytes_received < file.size) {
+            const bytes = await readSlice(file, status.bytes_received);
+            const headers = { 'X-Chunk-CRC32': String(crc32(bytes, 0)) };
+            let body = bytes;
+            const compressed = await gzip(bytes);
+            if (compressed && compressed.length < bytes.length) {
+                headers['Content-Encoding'] = 'gzip';
+                body = compressed;
+            }
+
+            const sent = await send(`/uploads/${status.id}/chunks/${status.next_chunk}`, { method: 'PUT', headers, body });
+            if (!sent.ok && sent.status !== 409) throw new Error(sent.body.error);
+            // On 409 the server tells us where it actually is; continue from there
+            status = sent.body;
+            progress(`Uploaded ${Math.round(100 * status.bytes_received / file.size)}%`);
+        }
+
+        progress('Importing...');
+        const done = await send(`/uploads/${status.id}/complete`, { method: 'POST' });
+        if (!done.ok) {
+            // 400: spool was corrupt, 422: import failed - either way start over next time
+            if (done.status === 400 || done.status === 422) localStorage.removeItem(resumeKey);
+            throw new Error(done.body.error);
+        }
+        localStorage.removeItem(resumeKey);
+        return done.body.result;
+    }
+
+    function showResult(form, title, lines, success) {
+        let box = document.getElementById('chunkedUploadResult');
+        if (!box) {
+            box = document.createElement('div');
+            box.id = 'chunkedUploadResult';
+            form.parentNode.insertBefore(box, form.nextSibling);
+        }
+        box.className = 'result-message ' + (success ? 'success' : 'warning');
+        box.replaceChildren();
+        const heading = document.createElement('h3');
+        heading.textContent = title;
+        box.appendChild(heading);
+        lines.forEach(line => {
+            const p = document.createElement('p');
+            p.textContent = line;
+            box.appendChild(p);
+        });
+    }
+
+    document.querySelectorAll('form.upload-form[data-kind]').forEach(form => {
+        if (!window.fetch || !Blob.prototype.slice || !window.localStorage) return;  // plain form post
+
+        form.addEventListener('submit', async (e) => {
+            const file = form.querySelector('input[type="file"]').files[0];
+            if (!file) return;
+            e.preventDefault();
+
+            const button = form.querySelector('button[type="submit"]');
+            button.disabled = true;
+            try {
+                const result = await upload(file, form.dataset.kind, text => showResult(form, 'Uploading...', [text], true));
+                const lines = result.result_message.split('<br>').filter(line => line);
+                showResult(form, 'Upload Result:', lines, result.success_count && result.error_count === 0);
+            } catch (err) {
+                showResult(form, 'Upload interrupted:', [String(err.message || err), 'Submit the same file again to resume.'], false);
+            } finally {
+                button.disabled = false;
+            }
+        });
+    });
+})();